@@ -0,0 +1,285 @@
+"""Opt-in metrics of measurement runs, exported in the Prometheus text format."""
+
+import bisect
+import contextlib
+import functools
+import http.server
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds of the measure duration histogram buckets in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+# Packages whose exceptions are counted as driver errors
+DRIVER_PACKAGES = ("nidcpower", "niscope")
+
+
+def _output_bytes(value: Any) -> int:
+    """Approximate size of a measurement output value: 8 bytes per number, 1 byte per character."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], (float, int)):
+            return 8 * len(value)
+        return sum(_output_bytes(item) for item in value)
+    if hasattr(value, "x_data"):
+        return 8 * (len(value.x_data) + len(value.y_data))
+    return getattr(value, "nbytes", 8)
+
+
+class _Histogram(object):
+    """Counts of observations per duration bucket, with their sum."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(DURATION_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class MeasurementMetrics(object):
+    """Counters of the measurement runs of one service.
+
+    Decorate the measure function with instrument() to count its runs per mode of operation and
+    outcome, the measure durations, the driver errors and the approximate bytes of the yielded
+    outputs. Nothing is recorded until enable() is called, then render() returns the metrics in
+    the Prometheus text exposition format.
+    """
+
+    def __init__(self, service_name: str) -> None:
+        """Initialize the metrics.
+
+        Args:
+            service_name: Value of the service label of every metric.
+        """
+        self.service_name = service_name
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._runs: Dict[Tuple[str, str], int] = {}
+        self._durations: Dict[str, _Histogram] = {}
+        self._driver_errors: Dict[Tuple[str, str], int] = {}
+        self._outputs: Dict[str, int] = {}
+        self._output_bytes: Dict[str, int] = {}
+        self._in_flight = 0
+
+    def enable(self) -> None:
+        """Start recording the measurement runs."""
+        self.enabled = True
+
+    def instrument(self, measure_function: Callable) -> Callable:
+        """Decorator that records the runs of a measure function, keeps its signature for the service."""
+
+        @functools.wraps(measure_function)
+        def measure(*args, **kwargs):
+            if not self.enabled:
+                return measure_function(*args, **kwargs)
+            mode = kwargs["mode_of_operation"] if "mode_of_operation" in kwargs else args[0]
+            mode = getattr(mode, "name", str(mode))
+            started = time.perf_counter()
+            try:
+                result = measure_function(*args, **kwargs)
+            except BaseException as e:
+                self._start()
+                self._finish(mode, started, e)
+                raise
+            if hasattr(result, "send"):
+                return self._generator(result, mode, started)
+            self._start()
+            self._record_outputs(mode, result)
+            self._finish(mode, started)
+            return result
+
+        return measure
+
+    def _generator(self, generator, mode: str, started: float):
+        # the run starts with the first next() and ends when the generator returns, raises or is
+        # closed by a canceled client
+        error: Optional[BaseException] = None
+        self._start()
+        try:
+            with contextlib.closing(generator):
+                while True:
+                    try:
+                        outputs = next(generator)
+                    except StopIteration as e:
+                        if e.value is not None:
+                            self._record_outputs(mode, e.value)
+                        return e.value
+                    self._record_outputs(mode, outputs)
+                    yield outputs
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(mode, started, error)
+
+    def _start(self) -> None:
+        with self._lock:
+            self._in_flight += 1
+
+    def _record_outputs(self, mode: str, outputs: tuple) -> None:
+        size = sum(_output_bytes(value) for value in outputs)
+        with self._lock:
+            self._outputs[mode] = self._outputs.get(mode, 0) + 1
+            self._output_bytes[mode] = self._output_bytes.get(mode, 0) + size
+
+    def _finish(self, mode: str, started: float, error: Optional[BaseException] = None) -> None:
+        elapsed = time.perf_counter() - started
+        if error is None:
+            outcome = "completed"
+        elif isinstance(error, GeneratorExit):
+            outcome = "canceled"
+        else:
+            outcome = "failed"
+        package = type(error).__module__.split(".")[0] if error is not None else ""
+        with self._lock:
+            self._in_flight -= 1
+            self._runs[mode, outcome] = self._runs.get((mode, outcome), 0) + 1
+            self._durations.setdefault(mode, _Histogram()).observe(elapsed)
+            if package in DRIVER_PACKAGES:
+                key = (package, type(error).__name__)
+                self._driver_errors[key] = self._driver_errors.get(key, 0) + 1
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        service = f'service="{self.service_name}"'
+        lines = []
+
+        def header(name: str, metric_type: str, description: str) -> None:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        with self._lock:
+            header("pmic_measurements_total", "counter", "Measurement runs by mode of operation and outcome.")
+            for (mode, outcome), count in sorted(self._runs.items()):
+                lines.append(f'pmic_measurements_total{{{service},mode="{mode}",outcome="{outcome}"}} {count}')
+
+            header("pmic_measurements_in_flight", "gauge", "Measurement runs that have not finished.")
+            lines.append(f"pmic_measurements_in_flight{{{service}}} {self._in_flight}")
+
+            header("pmic_measure_duration_seconds", "histogram", "Duration of the measurement runs.")
+            for mode, histogram in sorted(self._durations.items()):
+                labels = f'{service},mode="{mode}"'
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'pmic_measure_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"pmic_measure_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"pmic_measure_duration_seconds_count{{{labels}}} {histogram.count}")
+
+            header("pmic_driver_errors_total", "counter", "Driver exceptions that ended measurement runs.")
+            for (driver, error), count in sorted(self._driver_errors.items()):
+                lines.append(f'pmic_driver_errors_total{{{service},driver="{driver}",error="{error}"}} {count}')
+
+            header("pmic_outputs_total", "counter", "Results returned or yielded to the client.")
+            for mode, count in sorted(self._outputs.items()):
+                lines.append(f'pmic_outputs_total{{{service},mode="{mode}"}} {count}')
+
+            header("pmic_output_bytes_total", "counter", "Approximate size of the returned and yielded results.")
+            for mode, size in sorted(self._output_bytes.items()):
+                lines.append(f'pmic_output_bytes_total{{{service},mode="{mode}"}} {size}')
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(object):
+    """Serves the metrics on a localhost HTTP port and/or writes them to a file periodically.
+
+    Use as a context manager around the hosted service. Exporting enables the metrics.
+    """
+
+    def __init__(
+        self,
+        metrics: MeasurementMetrics,
+        port: Optional[int] = None,
+        file_path: Optional[str] = None,
+        interval: float = 10.0,
+    ) -> None:
+        """Initialize the exporter.
+
+        Args:
+            metrics: The metrics to export.
+            port: Port of the HTTP endpoint on 127.0.0.1, 0 picks a free port. None serves nothing.
+            file_path: File that is rewritten with the metrics every interval. None writes nothing.
+            interval: Seconds between two writes of the file.
+        """
+        self.metrics = metrics
+        self.port = port
+        self.file_path = file_path
+        self.interval = interval
+        self._server: Optional[http.server.ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._threads: list = []
+
+    def __enter__(self) -> "MetricsExporter":
+        if self.port is None and self.file_path is None:
+            return self
+        self.metrics.enable()
+        if self.port is not None:
+            self._server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            self._start_thread(self._server.serve_forever)
+            _logger.info("Serving metrics at http://127.0.0.1:%d/metrics", self.port)
+        if self.file_path is not None:
+            self._start_thread(self._write_periodically)
+            _logger.info("Writing metrics to %s every %g s", self.file_path, self.interval)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        if self.file_path is not None:
+            self.write()
+
+    def write(self) -> None:
+        """Replace the metrics file with the current metrics, readers never see a partial file."""
+        temporary_path = f"{self.file_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(self.metrics.render())
+        os.replace(temporary_path, self.file_path)
+
+    def _start_thread(self, target: Callable) -> None:
+        thread = threading.Thread(target=target, name="metrics exporter", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _write_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                _logger.warning("Cannot write the metrics file: %s", e)
+
+    def _handler(self) -> type:
+        metrics = self.metrics
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # noqa: N802 - name required by BaseHTTPRequestHandler
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                _logger.debug("Metrics request: " + format, *args)
+
+        return MetricsHandler
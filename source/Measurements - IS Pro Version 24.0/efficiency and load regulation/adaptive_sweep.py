@@ -0,0 +1,66 @@
+"""Adaptive refinement of the load current sweep of the efficiency and load regulation measurement."""
+
+import numpy as np
+
+from efficiency_results import EfficiencyResults
+
+
+def refinement_levels(
+        load_current_levels: np.ndarray,
+        results: EfficiencyResults,
+        points: int,
+        logarithmic: bool = False
+) -> np.ndarray:
+    """Pick new load current levels where the measured curves change the most.
+
+    Every interval between neighbouring load current levels is scored by the largest change of
+    the efficiency or the load voltage across it, over all source voltages and relative to the
+    range of that quantity. A new level is put in the middle of each of the highest scoring
+    intervals, the geometric middle for logarithmic sweeps.
+
+    Args:
+        load_current_levels: The sorted load current levels of the results.
+        results: The complete results of the sweep over these levels.
+        points: Maximum number of new levels.
+        logarithmic: Whether the sweep is logarithmic.
+
+    Returns:
+        The new load current levels in ascending order.
+    """
+    levels = np.asarray(load_current_levels, dtype=np.float64)
+    if points <= 0 or levels.size < 2 or results.count < results.load_currents.size:
+        return np.empty(0)
+    score = np.zeros(levels.size - 1)
+    for quantity in (results.efficiency, results.load_voltages):
+        span = np.ptp(quantity)
+        if span > 0:
+            score = np.maximum(score, np.abs(np.diff(quantity, axis=1)).max(axis=0) / span)
+    # intervals whose middle is not representable any more cannot be refined
+    score[np.diff(levels) <= np.spacing(levels[1:]) * 2] = 0
+    intervals = np.argsort(score, kind='stable')[::-1][:points]
+    intervals = intervals[score[intervals] > 0]
+    low = levels[intervals]
+    high = levels[intervals + 1]
+    middle = np.sqrt(low * high) if logarithmic else (low + high) / 2
+    return np.sort(middle)
+
+
+def merge_results(
+        results: EfficiencyResults,
+        load_current_levels: np.ndarray,
+        new_results: EfficiencyResults,
+        new_load_current_levels: np.ndarray
+) -> tuple:
+    """Combine the results of two sweeps over the same source voltages into one.
+
+    Returns:
+        The merged results and their load current levels, both in ascending load current order.
+    """
+    levels = np.concatenate((load_current_levels, new_load_current_levels))
+    order = np.argsort(levels, kind='stable')
+    merged = EfficiencyResults(results.shape[0], levels.size, results.nominal_output_voltage)
+    for quantity in EfficiencyResults.QUANTITIES:
+        grids = (getattr(results, quantity), getattr(new_results, quantity))
+        getattr(merged, quantity)[:] = np.concatenate(grids, axis=1)[:, order]
+    merged.count = merged.load_currents.size
+    return merged, levels[order]
@@ -0,0 +1,77 @@
+"""Result grids of the efficiency and load regulation sweep."""
+
+import numpy as np
+
+
+class EfficiencyResults(object):
+    """Preallocated (source voltages x load currents) grids of the sweep results.
+
+    Measurements are written in place in sweep order, one source voltage row after the other.
+    flat() returns the results measured so far as one array, the layout of the service outputs,
+    and row() returns the results of one source voltage. Both are views of the grids, no data
+    is copied.
+    """
+
+    QUANTITIES = ('load_currents', 'efficiency', 'load_voltages', 'load_voltage_deviation')
+
+    def __init__(self, source_sweep_points: int, load_sweep_points: int, nominal_output_voltage: float) -> None:
+        """Initialize the grids.
+
+        Args:
+            source_sweep_points: Number of source voltages, the rows of the grids.
+            load_sweep_points: Number of load currents per source voltage, the columns of the grids.
+            nominal_output_voltage: The expected output voltage that deviations are relative to.
+        """
+        shape = (max(source_sweep_points, 0), max(load_sweep_points, 0))
+        self.nominal_output_voltage = nominal_output_voltage
+        self.load_currents = np.zeros(shape)
+        self.efficiency = np.zeros(shape)
+        self.load_voltages = np.zeros(shape)
+        self.load_voltage_deviation = np.zeros(shape)
+        self.count = 0
+
+    @property
+    def shape(self) -> tuple:
+        """Number of source voltages and load currents of the sweep."""
+        return self.load_currents.shape
+
+    def append(self, source_voltages, source_currents, load_voltages, load_currents) -> None:
+        """Add the next measurements of the sweep.
+
+        Args:
+            source_voltages, source_currents, load_voltages, load_currents:
+                Single values or equally long arrays of the next sweep points.
+        """
+        source_power = np.asarray(source_voltages, dtype=np.float64) * np.asarray(source_currents, dtype=np.float64)
+        load_voltages = np.asarray(load_voltages, dtype=np.float64)
+        load_currents = np.abs(np.asarray(load_currents, dtype=np.float64))
+        points = slice(self.count, self.count + load_voltages.size)
+        if points.stop > self.load_currents.size:
+            raise ValueError(f"The sweep has only {self.load_currents.size} points.")
+        self.load_currents.reshape(-1)[points] = load_currents
+        self.load_voltages.reshape(-1)[points] = load_voltages
+        self.efficiency.reshape(-1)[points] = np.abs(load_voltages * load_currents * 100 / source_power)
+        self.load_voltage_deviation.reshape(-1)[points] = (
+            (load_voltages - self.nominal_output_voltage) / self.nominal_output_voltage * 100
+        )
+        self.count = points.stop
+
+    def flat(self, quantity: str) -> np.ndarray:
+        """Results of a quantity measured so far, in sweep order."""
+        return getattr(self, quantity).reshape(-1)[:self.count]
+
+    def row(self, quantity: str, source_index: int) -> np.ndarray:
+        """Results of a quantity for all load currents of one source voltage."""
+        return getattr(self, quantity)[source_index]
+
+    def outputs(self, deltas: list = None) -> tuple:
+        """Flat results of every quantity as lists, in the order of QUANTITIES.
+
+        Args:
+            deltas:
+                One OutputDelta per quantity. If given, only the points measured since the previous
+                call are returned.
+        """
+        if deltas is None:
+            return tuple(self.flat(quantity).tolist() for quantity in self.QUANTITIES)
+        return tuple(delta(self.flat(quantity)).tolist() for delta, quantity in zip(deltas, self.QUANTITIES))
@@ -5,6 +5,11 @@ import sys
 import click
 import ni_measurementlink_service as nims
 
+from _helpers import OutputDelta, UpdateThrottle
+from _metrics import MeasurementMetrics, MetricsExporter
+from _result_log import FORMATS, ResultLog
+from _stage_timing import StageTimer, stage, timed_measurement
+from adaptive_sweep import merge_results, refinement_levels
 from configure_dc_power import * #for setting power supply and eload configuration
 
 script_or_exe = sys.executable if getattr(sys, "frozen", False) else __file__
@@ -14,6 +19,8 @@ measurement_service = nims.MeasurementService(
     version="1.0.0.0",
     ui_file_paths=[service_directory / "EfficiencyAndLoadRegulation_PMIC.vi"],
 )
+metrics = MeasurementMetrics('Efficiency and load regulation')
+result_log = ResultLog(measurement_service, 'efficiency_and_load_regulation')
 
 
 @measurement_service.register_measurement
@@ -39,6 +46,16 @@ measurement_service = nims.MeasurementService(
 @measurement_service.configuration('Load start current', nims.DataType.Double, 0.1)
 @measurement_service.configuration('Load stop current', nims.DataType.Double, 24.0)
 @measurement_service.configuration('Load current sweep points/points per decade', nims.DataType.Int32, 10)
+# Adaptive sweep: after the sweep, every refinement pass measures new load currents in the middle of the intervals
+# where the efficiency or the load voltage change the most, 0 passes keeps the fixed sweep
+@measurement_service.configuration('Load sweep refinement passes', nims.DataType.Int32, 0)
+@measurement_service.configuration('Load sweep refinement points per pass', nims.DataType.Int32, 10)
+# Incremental updates send only the points measured since the previous update, the final result is complete
+@measurement_service.configuration('Incremental updates', nims.DataType.Boolean, False)
+# Intermediate results are sent at most once per interval, 0 sends every update
+@measurement_service.configuration('Minimum update interval (s)', nims.DataType.Double, 0.0)
+# The time spent in every stage of the run is returned in the timing output, it is always logged with -v
+@measurement_service.configuration('Report timing', nims.DataType.Boolean, False)
 # configure outputs
 @measurement_service.output('Status', nims.DataType.String)
 @measurement_service.output('Voltage values', nims.DataType.DoubleArray1D)
@@ -48,6 +65,10 @@ measurement_service = nims.MeasurementService(
 @measurement_service.output('Efficiency', nims.DataType.DoubleArray1D)
 @measurement_service.output('Load voltages', nims.DataType.DoubleArray1D)
 @measurement_service.output('Load voltage deviation', nims.DataType.DoubleArray1D)
+@measurement_service.output('Timing', nims.DataType.String)
+@result_log.instrument
+@metrics.instrument
+@timed_measurement
 def measure(
         mode_of_operation: Enum,
         dut_setup_time: float,
@@ -66,6 +87,11 @@ def measure(
         load_start_current: float,
         load_stop_current: float,
         load_current_sweep_points_points_per_decade: int,
+        load_sweep_refinement_passes: int,
+        load_sweep_refinement_points_per_pass: int,
+        incremental_updates: bool,
+        minimum_update_interval: float,
+        report_timing: bool,
 ):
     # Constants
     source_device_channel: str = '0'
@@ -80,6 +106,8 @@ def measure(
     efficiency: list[float] = list()
     load_voltages: list[float] = list()
     load_voltage_deviation: list[float] = list()
+    timing: str = str()
+    timer = StageTimer('Efficiency and load regulation')
     # Measure logic start
     if mode_of_operation == ModeOfOperation.Power_On_DUT:
         res = power_on_dut(source_resource_name, source_device_channel, source_start_voltage, source_current_limit)
@@ -90,18 +118,20 @@ def measure(
 
         if load_sweep_type.lower() == 'logarithmic':
             load_sweep_type_enum = SweepType.Logarithmic
+        elif load_sweep_type.lower() == 'logarithmic points':
+            load_sweep_type_enum = SweepType.LogarithmicPoints
         elif load_sweep_type.lower() != 'linear':
             raise ValueError(f'{load_sweep_type} Sweep Type is not supported ')
 
-        source_session = Session(source_resource_name, source_device_channel)
-        load_session = Session(load_resource_name, load_device_channel)
+        source_session = session_pool.acquire(source_resource_name, source_device_channel)
+        load_session = session_pool.acquire(load_resource_name, load_device_channel)
         try:
             voltage_values = generate_sequence(
                 SweepType.Linear,
                 source_start_voltage,
                 source_stop_voltage,
                 source_voltage_sweep_points
-            )
+            ).tolist()
             initiate_source(
                 source_session,
                 source_device_channel,
@@ -125,65 +155,125 @@ def measure(
             )
 
             load_sweep_points = len(current_results)
-            current_values = len(voltage_values) * current_results
-
-            configure_source(
-                source_session,
-                source_device_channel,
-                voltage_values,
-                source_current_limit,
-                source_maximum_power,
-                load_sweep_points,
-                source_delay,
-                aperture_time
-            )
-            configure_load(
-                load_session,
-                load_device_channel,
-                current_values,
-                load_voltage_limit_range,
-                aperture_time,
-                build_trigger_terminal(source_resource_name, source_device_channel, 'SourceTrigger'),
-                build_trigger_terminal(source_resource_name, source_device_channel, 'SourceCompleteEvent')
-            )
-
-            load_session.channels[load_device_channel].initiate()
-            source_session.channels[source_device_channel].initiate()
-
-            load_session.channels[load_device_channel].wait_for_event(event_id=Event.SEQUENCE_ENGINE_DONE)
             source_sweep_points = len(voltage_values)
+            # the load current sweep is repeated for every source voltage
+            current_values = generate_sequence(
+                load_sweep_type_enum,
+                load_start_current,
+                load_stop_current,
+                load_current_sweep_points_points_per_decade,
+                repetitions=source_sweep_points
+            )
 
-            gen = perform_measurements(
+            results = EfficiencyResults(source_sweep_points, load_sweep_points, nominal_output_voltage)
+            gen = run_sweep(
                 source_session,
+                source_resource_name,
                 source_device_channel,
                 load_session,
                 load_device_channel,
                 voltage_values,
+                current_values.tolist(),
                 load_sweep_points,
-                nominal_output_voltage,
-                load_currents,
-                load_voltages,
-                efficiency,
-                load_voltage_deviation
+                source_current_limit,
+                source_maximum_power,
+                load_voltage_limit_range,
+                source_delay,
+                aperture_time,
+                results
             )
+            update_throttle = UpdateThrottle(minimum_update_interval)
+            deltas = [OutputDelta() for _ in EfficiencyResults.QUANTITIES]
             for _ in gen:
-                yield (
-                    status,
-                    voltage_values,
-                    source_sweep_points,
-                    load_sweep_points,
-                    load_currents,
-                    efficiency,
-                    load_voltages,
-                    load_voltage_deviation,
-                )
+                if not update_throttle.due():
+                    continue
+                # the outputs are the flat result arrays, one source voltage after the other
+                with stage('processing'):
+                    load_currents, efficiency, load_voltages, load_voltage_deviation = results.outputs(
+                        deltas if incremental_updates else None
+                    )
+                if report_timing:
+                    timing = timer.summary()
+                with stage('yield'):
+                    yield (
+                        status,
+                        voltage_values,
+                        source_sweep_points,
+                        load_sweep_points,
+                        load_currents,
+                        efficiency,
+                        load_voltages,
+                        load_voltage_deviation,
+                        timing,
+                    )
                 pass
+            with stage('processing'):
+                load_currents, efficiency, load_voltages, load_voltage_deviation = results.outputs()
+
+            # every refinement pass is a hardware-sequenced sweep over the new load currents only,
+            # the outputs are updated once its results are merged in load current order. The merged
+            # points are inserted between the previous ones, so these updates are always complete
+            for _ in range(load_sweep_refinement_passes):
+                with stage('processing'):
+                    new_current_levels = refinement_levels(
+                        current_results,
+                        results,
+                        load_sweep_refinement_points_per_pass,
+                        load_sweep_type_enum != SweepType.Linear
+                    )
+                if new_current_levels.size == 0:
+                    break
+                finish_sweep(source_session, source_device_channel, load_session, load_device_channel)
+                new_results = EfficiencyResults(source_sweep_points, new_current_levels.size, nominal_output_voltage)
+                for _ in run_sweep(
+                        source_session,
+                        source_resource_name,
+                        source_device_channel,
+                        load_session,
+                        load_device_channel,
+                        voltage_values,
+                        np.tile(new_current_levels, source_sweep_points).tolist(),
+                        new_current_levels.size,
+                        source_current_limit,
+                        source_maximum_power,
+                        load_voltage_limit_range,
+                        source_delay,
+                        aperture_time,
+                        new_results
+                ):
+                    pass
+                with stage('processing'):
+                    results, current_results = merge_results(results, current_results, new_results,
+                                                             new_current_levels)
+                    load_sweep_points = len(current_results)
+                    load_currents, efficiency, load_voltages, load_voltage_deviation = results.outputs()
+                if report_timing:
+                    timing = timer.summary()
+                with stage('yield'):
+                    yield (
+                        status,
+                        voltage_values,
+                        source_sweep_points,
+                        load_sweep_points,
+                        load_currents,
+                        efficiency,
+                        load_voltages,
+                        load_voltage_deviation,
+                        timing,
+                    )
 
             reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
             status = 'The measurement is performed successfully'
 
+        except GeneratorExit:
+            # the client canceled the measurement, the sweep is stopped and the sessions go back to the pool
+            try:
+                reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            except Exception:
+                discard_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            raise
         except Exception:
-            reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            discard_sessions(source_session, source_device_channel, load_session, load_device_channel)
             raise
         pass
 
@@ -192,6 +282,7 @@ def measure(
         status = 'The DUT is powered off'
         pass
     # Measure logic end
+    timing = timer.finish()
     return (
         status,
         voltage_values,
@@ -201,6 +292,7 @@ def measure(
         efficiency,
         load_voltages,
         load_voltage_deviation,
+        timing if report_timing else str(),
     )
 
 
@@ -211,7 +303,47 @@ def measure(
     count=True,
     help="Enable verbose logging. Repeat to increase verbosity.",
 )
-def main(verbose: int) -> None:
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=None,
+    help="Serve measurement metrics at http://127.0.0.1:PORT/metrics.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write measurement metrics to this file periodically.",
+)
+@click.option(
+    "--metrics-interval",
+    type=float,
+    default=10.0,
+    show_default=True,
+    help="Seconds between two writes of the metrics file.",
+)
+@click.option(
+    "--result-log",
+    "result_log_directory",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Log the configuration and results of every measurement run to files in this directory.",
+)
+@click.option(
+    "--result-log-format",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="File format of the result log, Parquet or Arrow IPC stream. Requires the pyarrow package.",
+)
+def main(
+    verbose: int,
+    metrics_port: int,
+    metrics_file: str,
+    metrics_interval: float,
+    result_log_directory: str,
+    result_log_format: str,
+) -> None:
     if verbose > 1:
         level = logging.DEBUG
     elif verbose == 1:
@@ -220,8 +352,12 @@ def main(verbose: int) -> None:
         level = logging.WARNING
     logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=level)
 
-    with measurement_service.host_service():
-        input("Press enter to close the measurement service.\n")
+    if result_log_directory:
+        result_log.start(result_log_directory, result_log_format)
+    with result_log, MetricsExporter(metrics, metrics_port, metrics_file, metrics_interval):
+        with measurement_service.host_service():
+            input("Press enter to close the measurement service.\n")
+    session_pool.close_all()
 
 
 if __name__ == "__main__":
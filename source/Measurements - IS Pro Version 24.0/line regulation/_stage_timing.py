@@ -0,0 +1,139 @@
+"""Per-stage timing of measurement runs."""
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+# the timer of the measurement run that is executing on a thread
+_active = threading.local()
+_no_stage = contextlib.nullcontext()
+
+
+class StageTimer(object):
+    """Monotonic time spent in the stages of one measurement run.
+
+    Creating a timer makes it the active timer of the calling thread, so the configure and fetch
+    helpers record their stages with the module-level stage() without a timer argument. A stage
+    that is entered inside another stage is not counted in the outer one, and the time outside of
+    every stage is reported as "other".
+    """
+
+    def __init__(self, name: str) -> None:
+        """Start timing a measurement run.
+
+        Args:
+            name: Name of the run in the log message.
+        """
+        self.name = name
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._started = time.perf_counter()
+        self._finished: Optional[float] = None
+        # [stage name, start time, time spent in nested stages] of the stages that are entered
+        self._stack: List[list] = []
+        _active.timer = self
+
+    def stage(self, name: str) -> "_Stage":
+        """Time a stage of the run, use the result as a context manager."""
+        return _Stage(self, name)
+
+    def _enter(self, name: str) -> None:
+        if name not in self.durations:
+            self.durations[name] = 0.0
+            self.counts[name] = 0
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def _exit(self) -> None:
+        name, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.durations[name] += elapsed - nested
+        self.counts[name] += 1
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    @property
+    def total(self) -> float:
+        """Time since the run started, or the duration of a finished run, in seconds."""
+        return (self._finished or time.perf_counter()) - self._started
+
+    def summary(self) -> str:
+        """The time of every stage in the order the stages were first entered, one stage per line."""
+        total = self.total
+        lines = [f"{name}: {seconds * 1000:.3f} ms ({self.counts[name]}x)" for name, seconds in self.durations.items()]
+        lines.append(f"other: {max(total - sum(self.durations.values()), 0.0) * 1000:.3f} ms")
+        lines.append(f"total: {total * 1000:.3f} ms")
+        return "\n".join(lines)
+
+    def finish(self) -> str:
+        """Stop the timer, log the stage times at INFO level and return them."""
+        if self._finished is None:
+            self._finished = time.perf_counter()
+            if getattr(_active, "timer", None) is self:
+                _active.timer = None
+            if _logger.isEnabledFor(logging.INFO):
+                _logger.info("%s timing:\n%s", self.name, self.summary())
+        return self.summary()
+
+
+class _Stage(object):
+    """Context manager that times one stage, a plain class costs less than contextlib.contextmanager."""
+
+    __slots__ = ("_timer", "_name")
+
+    def __init__(self, timer: StageTimer, name: str) -> None:
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._timer._enter(self._name)
+
+    def __exit__(self, *exc_info) -> None:
+        self._timer._exit()
+
+
+def stage(name: str) -> contextlib.AbstractContextManager:
+    """Time a stage on the active timer of the calling thread. Does nothing if no run is timed."""
+    timer = getattr(_active, "timer", None)
+    return _Stage(timer, name) if timer is not None else _no_stage
+
+
+def finish_active_timer() -> None:
+    """Finish the active timer of the calling thread, if a run left it active."""
+    timer = getattr(_active, "timer", None)
+    if timer is not None:
+        timer.finish()
+
+
+def timed_measurement(measure_function: Callable) -> Callable:
+    """Decorator that finishes the timer of a measurement run when the run ends.
+
+    A run that raises, or a streaming run that the client cancels, never reaches its own finish(),
+    so its timer would stay active on the worker thread and collect the stages of the next run.
+    """
+
+    @functools.wraps(measure_function)
+    def measure(*args, **kwargs):
+        try:
+            result = measure_function(*args, **kwargs)
+        except BaseException:
+            finish_active_timer()
+            raise
+        if hasattr(result, "send"):
+            return _finish_timer_after(result)
+        finish_active_timer()
+        return result
+
+    return measure
+
+
+def _finish_timer_after(generator):
+    try:
+        return (yield from generator)
+    finally:
+        finish_active_timer()
+
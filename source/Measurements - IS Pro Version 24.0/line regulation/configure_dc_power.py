@@ -1,11 +1,18 @@
+import functools
+import math
 from enum import Enum
 
 import hightime
+import numpy as np
 from ni_measurementlink_service._internal.stubs.ni.protobuf.types.xydata_pb2 import DoubleXYData
 from nidcpower import (
     Session, Sense, SourceMode, OutputFunction, Error, Event, MeasureWhen, MeasurementTypes, TriggerType
 )
 
+from _helpers import extend_xy_data
+from _session_pool import session_pool
+from _stage_timing import stage
+
 
 # Mode of operation ENUM
 class ModeOfOperation(Enum):
@@ -19,6 +26,7 @@ class ModeOfOperation(Enum):
 class SweepType(Enum):
     Linear = 0
     Logarithmic = 1
+    LogarithmicPoints = 2
     pass
 
 
@@ -31,45 +39,52 @@ def format_power_on_result(voltage_level: float, current_level: float) -> str:
             f"Current Level: {current_string[:min(len(current_string), voltage_string.index('.')+4)]}")
 
 
-# function to generate series of values from start to stop in number of steps specified and SweepType
+# function to generate series of values from start to stop in number of steps specified and SweepType. Linear
+# and LogarithmicPoints sweeps have steps points, Logarithmic sweeps have steps points per decade. The sweep is
+# repeated repetitions times. The result is cached and read-only, copy it before modifying it
 def generate_sequence(
         sweep_type: Enum,
         start: float, stop: float,
         steps: int,
-        with_end_points: bool = True
-) -> list[float]:
-    res = []
-    if start > stop or steps <= 0:
-        return res
+        with_end_points: bool = True,
+        repetitions: int = 1
+) -> np.ndarray:
+    return _generate_sequence(sweep_type.value, float(start), float(stop), int(steps), bool(with_end_points),
+                              int(repetitions))
 
-    if sweep_type == SweepType.Linear:
+
+@functools.lru_cache(maxsize=32)
+def _generate_sequence(
+        sweep_type: int,
+        start: float, stop: float,
+        steps: int,
+        with_end_points: bool,
+        repetitions: int
+) -> np.ndarray:
+    res = np.empty(0)
+    if start > stop or steps <= 0:
+        pass
+    elif sweep_type == SweepType.Linear.value:
         if with_end_points:
-            if (steps-1==0): d=0
-            else: d = (stop - start) / (steps - 1)
-            for i in range(steps):
-                res.append((start + (i * d)))
-            return res
+            res = np.linspace(start, stop, steps) if steps > 1 else np.full(1, start)
         else:
-            d = (stop - start) / (steps + 1)
-            for i in range(steps + 2):
-                res.append((start + (i * d)))
-            return res[1:-1]
+            res = np.linspace(start, stop, steps + 2)[1:-1]
     else:
-        if with_end_points:
-            r = 10 ** (1 / (steps))
-            while True:
-                res.append(start * (r ** len(res)))
-                if res[-1] >= stop:
-                    res[-1] = stop
-                    return res
+        if start <= 0:
+            raise ValueError(f'Logarithmic sweeps need a positive start value, got {start}')
+        if sweep_type == SweepType.LogarithmicPoints.value:
+            res = np.geomspace(start, stop, steps + (0 if with_end_points else 2))
         else:
-            r = 10 ** (1 / (steps + 1))
-            while True:
-                res.append(start * (r ** len(res)))
-                if res[-1] >= stop:
-                    res[-1] = stop
-                    return res[1:-1]
-    pass
+            # points spaced by ratio r from start up to the first point at or beyond stop, which is set to stop
+            r = 10 ** (1 / (steps if with_end_points else steps + 1))
+            res = start * r ** np.arange(math.ceil(math.log(stop / start) / math.log(r)) + 2)
+            res = res[:int(np.argmax(res >= stop)) + 1]
+            res[-1] = stop
+        if not with_end_points:
+            res = res[1:-1]
+    res = np.tile(res, max(repetitions, 0))
+    res.flags.writeable = False
+    return res
 
 
 # function to determine current limit based on power boundary
@@ -92,37 +107,36 @@ def power_on_dut(
         voltage_level: float,
         current_limit: float
 ) -> tuple[float, float]:
-    session = Session(resource_name=resource_name, channels=channel_name)
+    session = session_pool.acquire(resource_name, channel_name)
     try:
         # configure the session
-        session.channels[channel_name].sense = Sense.REMOTE
-        session.channels[channel_name].source_mode = SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = OutputFunction.DC_VOLTAGE
-
-        session.channels[channel_name].voltage_level_autorange = True
-        session.channels[channel_name].current_limit_autorange = True
-
-        session.channels[channel_name].current_limit = current_limit
-        session.channels[channel_name].voltage_level = voltage_level
-
-        session.channels[channel_name].commit()
-        session.channels[channel_name].measure_when = MeasureWhen.ON_DEMAND
-        session.channels[channel_name].initiate()
-
-        session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE, timeout=5)
-        voltage = session.channels[channel_name].measure(measurement_type=MeasurementTypes.VOLTAGE)
-        current = session.channels[channel_name].measure(measurement_type=MeasurementTypes.CURRENT)
+        session_pool.configure(session, channel_name, {
+            'sense': Sense.REMOTE,
+            'source_mode': SourceMode.SINGLE_POINT,
+            'output_function': OutputFunction.DC_VOLTAGE,
+            'voltage_level_autorange': True,
+            'current_limit_autorange': True,
+            'current_limit': current_limit,
+            'voltage_level': voltage_level,
+            'measure_when': MeasureWhen.ON_DEMAND,
+        })
+        with stage("initiate"):
+            session.channels[channel_name].initiate()
+
+        with stage("DUT setup"):
+            session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE, timeout=5)
+        with stage("measure"):
+            voltage = session.channels[channel_name].measure(measurement_type=MeasurementTypes.VOLTAGE)
+            current = session.channels[channel_name].measure(measurement_type=MeasurementTypes.CURRENT)
 
         session.channels[channel_name].abort()
-        session.close()
+        session_pool.release(session)
 
         return voltage, current
 
     except Error:
         session.channels[channel_name].abort()
-        session.output_enabled = False
-        session.channels[channel_name].reset()
-        session.close()
+        session_pool.discard(session)
         raise
 
     pass
@@ -135,21 +149,23 @@ def power_off_dut(
         load_resource_name: str,
         load_device_channel: str
 ) -> None:
-    source_session = Session(resource_name=source_resource_name, channels=source_device_channel)
-    load_session = Session(resource_name=load_resource_name, channels=load_device_channel)
+    source_session = session_pool.acquire(source_resource_name, source_device_channel)
+    load_session = session_pool.acquire(load_resource_name, load_device_channel)
 
     source_session.channels[source_device_channel].output_enabled = False
     load_session.channels[load_device_channel].output_enabled = False
 
     source_session.channels[source_device_channel].reset()
     load_session.channels[load_device_channel].reset()
+    session_pool.invalidate(source_session, source_device_channel)
+    session_pool.invalidate(load_session, load_device_channel)
 
-    source_session.close()
-    load_session.close()
+    session_pool.release(source_session)
+    session_pool.release(load_session)
     return
 
 
-# function to power off power supplies in case of error in perform measurement
+# function to power off power supplies after perform measurement, the sessions stay open in the pool
 def reset_sessions(
         source_session: Session,
         source_device_channel: str,
@@ -158,15 +174,31 @@ def reset_sessions(
 ) -> None:
     source_session.channels[source_device_channel].abort()
     load_session.channels[load_device_channel].abort()
+    delete_source_sequence(source_session, source_device_channel)
 
     source_session.channels[source_device_channel].output_enabled = False
     load_session.channels[load_device_channel].output_enabled = False
 
     source_session.channels[source_device_channel].reset()
     load_session.channels[load_device_channel].reset()
+    session_pool.invalidate(source_session, source_device_channel)
+    session_pool.invalidate(load_session, load_device_channel)
 
-    source_session.close()
-    load_session.close()
+    session_pool.release(source_session)
+    session_pool.release(load_session)
+
+
+# function to power off power supplies and close their sessions in case of error in perform measurement
+def discard_sessions(
+        source_session: Session,
+        source_device_channel: str,
+        load_session: Session,
+        load_device_channel: str
+) -> None:
+    try:
+        session_pool.discard(source_session)
+    finally:
+        session_pool.discard(load_session)
 
 
 # function to start source device and keep power sourcing on
@@ -178,22 +210,22 @@ def initiate_source(
         power_limit: float,
         source_delay: float
 ) -> None:
-    # configure the source session
-    session.channels[channel_name].sense = Sense.REMOTE
-    session.channels[channel_name].source_mode = SourceMode.SINGLE_POINT
-    session.channels[channel_name].output_function = OutputFunction.DC_VOLTAGE
-
-    session.channels[channel_name].voltage_level_autorange = True
-    session.channels[channel_name].current_limit_autorange = True
-
-    session.channels[channel_name].voltage_level = voltage_level
-    session.channels[channel_name].current_limit = get_current_limit(voltage_level, current_limit, power_limit)
-    session.channels[channel_name].source_delay = source_delay
-
-    session.channels[channel_name].commit()
-    session.channels[channel_name].initiate()
+    # configure the source session, only the properties that changed since they were last committed are written
+    session_pool.configure(session, channel_name, {
+        'sense': Sense.REMOTE,
+        'source_mode': SourceMode.SINGLE_POINT,
+        'output_function': OutputFunction.DC_VOLTAGE,
+        'voltage_level_autorange': True,
+        'current_limit_autorange': True,
+        'voltage_level': voltage_level,
+        'current_limit': get_current_limit(voltage_level, current_limit, power_limit),
+        'source_delay': source_delay,
+    })
+    with stage("initiate"):
+        session.channels[channel_name].initiate()
 
-    session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE)
+    with stage("DUT setup"):
+        session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE)
     session.channels[channel_name].abort()
     return
 
@@ -206,55 +238,95 @@ def initiate_load(
         voltage_limit_range: float,
         source_delay: float
 ) -> None:
-    # configure the load session
-    session.channels[channel_name].sense = Sense.REMOTE
-    session.channels[channel_name].source_mode = SourceMode.SINGLE_POINT
-    session.channels[channel_name].output_function = OutputFunction.DC_CURRENT
-
-    session.channels[channel_name].current_level_autorange = True
+    # configure the load session, only the properties that changed since they were last committed are written
+    session_pool.configure(session, channel_name, {
+        'sense': Sense.REMOTE,
+        'source_mode': SourceMode.SINGLE_POINT,
+        'output_function': OutputFunction.DC_CURRENT,
+        'current_level_autorange': True,
+        'current_level': current_level,
+        'voltage_limit_range': voltage_limit_range,
+        'source_delay': source_delay,
+    })
+    with stage("initiate"):
+        session.channels[channel_name].initiate()
 
-    session.channels[channel_name].current_level = current_level
-    session.channels[channel_name].voltage_limit_range = voltage_limit_range
-    session.channels[channel_name].source_delay = source_delay
+    with stage("DUT setup"):
+        session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE)
+    session.channels[channel_name].abort()
+    return
 
-    session.channels[channel_name].commit()
-    session.channels[channel_name].initiate()
 
-    session.channels[channel_name].wait_for_event(event_id=Event.SOURCE_COMPLETE)
-    session.channels[channel_name].abort()
+# function to remove the advanced sequence that a previous sweep left on a pooled source session, so the next
+# sweep does not run while it is still active
+def delete_source_sequence(session: Session, channel_name: str) -> None:
+    session.channels[channel_name].active_advanced_sequence = ''
+    try:
+        session.channels[channel_name].delete_advanced_sequence('SourceVoltages')
+    except Error:
+        # the session has no advanced sequence
+        pass
     return
 
 
-# function to configure source for perform measurement
-def configure_source(
+# function to program the voltage sweep of the source. When the power limit does not reduce the current limit of
+# any step, the whole sweep is loaded with one set_sequence call, otherwise every step is programmed separately
+# in an advanced sequence with its own current limit
+def program_source_sequence(
         session: Session,
         channel_name: str,
-        voltage_levels: list[float],
+        voltage_levels: np.ndarray,
         current_limit: float,
         power_limit: float,
-        source_delay: float,
-        aperture_time: float
+        source_delay: float
 ) -> None:
-    # configure the source session
-    session.channels[channel_name].sense = Sense.REMOTE
-    session.channels[channel_name].source_mode = SourceMode.SEQUENCE
-    session.channels[channel_name].output_function = OutputFunction.DC_VOLTAGE
-
-    session.channels[channel_name].voltage_level_autorange = True
-    session.channels[channel_name].current_limit_autorange = True
-    session.channels[channel_name].source_delay = source_delay
+    # the driver only takes writable buffers, the cached sweeps are read-only
+    voltage_levels = np.asarray(voltage_levels, dtype=np.float64).tolist()
+    current_limits = [get_current_limit(voltage_level, current_limit, power_limit) for voltage_level in voltage_levels]
+    # the sequence writes the levels directly, so the next configuration writes them again
+    session_pool.invalidate(session, channel_name, ('voltage_level', 'current_limit'))
+    delete_source_sequence(session, channel_name)
+    if len(set(current_limits)) <= 1:
+        session.channels[channel_name].current_limit = current_limits[0] if current_limits else current_limit
+        session.channels[channel_name].set_sequence(voltage_levels, [source_delay] * len(voltage_levels))
+        return
 
     session.channels[channel_name].create_advanced_sequence('SourceVoltages', ['voltage_level', 'current_limit'])
-
-    for i in voltage_levels:
+    for voltage_level, step_current_limit in zip(voltage_levels, current_limits):
         session.channels[channel_name].create_advanced_sequence_step()
-        session.channels[channel_name].voltage_level = i
-        session.channels[channel_name].current_limit = get_current_limit(i, current_limit, power_limit)
+        session.channels[channel_name].voltage_level = voltage_level
+        session.channels[channel_name].current_limit = step_current_limit
+    return
 
-    session.channels[channel_name].measure_when = MeasureWhen.AUTOMATICALLY_AFTER_SOURCE_COMPLETE
-    session.channels[channel_name].aperture_time = aperture_time
 
-    session.channels[channel_name].commit()
+# function to configure source for perform measurement
+def configure_source(
+        session: Session,
+        channel_name: str,
+        voltage_levels: np.ndarray,
+        current_limit: float,
+        power_limit: float,
+        source_delay: float,
+        aperture_time: float
+) -> None:
+    # configure the source session, only the properties that changed since they were last committed are written.
+    # The sequence is committed together with them
+    session_pool.configure(session, channel_name, {
+        'sense': Sense.REMOTE,
+        'source_mode': SourceMode.SEQUENCE,
+        'output_function': OutputFunction.DC_VOLTAGE,
+        'voltage_level_autorange': True,
+        'current_limit_autorange': True,
+        'source_delay': source_delay,
+        'measure_when': MeasureWhen.AUTOMATICALLY_AFTER_SOURCE_COMPLETE,
+        'aperture_time': aperture_time,
+    }, commit=False)
+
+    with stage("configure"):
+        program_source_sequence(session, channel_name, voltage_levels, current_limit, power_limit, source_delay)
+
+    with stage("commit"):
+        session.channels[channel_name].commit()
     return
 
 
@@ -268,52 +340,72 @@ def configure_load(
         source_terminal_name: str,
         measure_terminal_name: str
 ) -> None:
-    # configure the load session
-    session.channels[channel_name].sense = Sense.REMOTE
-    session.channels[channel_name].source_mode = SourceMode.SINGLE_POINT
-    session.channels[channel_name].output_function = OutputFunction.DC_CURRENT
-
-    session.channels[channel_name].current_level_autorange = True
-    session.channels[channel_name].voltage_limit_range = voltage_limit_range
-    session.channels[channel_name].current_level = current_level
-
-    session.channels[channel_name].source_trigger_type = TriggerType.DIGITAL_EDGE
-    session.channels[channel_name].measure_trigger_type = TriggerType.DIGITAL_EDGE
-
-    session.channels[channel_name].digital_edge_source_trigger_input_terminal = source_terminal_name
-    session.channels[channel_name].measure_when = MeasureWhen.ON_MEASURE_TRIGGER
-    session.channels[channel_name].aperture_time = aperture_time
-    session.channels[channel_name].digital_edge_measure_trigger_input_terminal = measure_terminal_name
-
-    session.channels[channel_name].commit()
+    # configure the load session, only the properties that changed since they were last committed are written
+    session_pool.configure(session, channel_name, {
+        'sense': Sense.REMOTE,
+        'source_mode': SourceMode.SINGLE_POINT,
+        'output_function': OutputFunction.DC_CURRENT,
+        'current_level_autorange': True,
+        'voltage_limit_range': voltage_limit_range,
+        'current_level': current_level,
+        'source_trigger_type': TriggerType.DIGITAL_EDGE,
+        'measure_trigger_type': TriggerType.DIGITAL_EDGE,
+        'digital_edge_source_trigger_input_terminal': source_terminal_name,
+        'measure_when': MeasureWhen.ON_MEASURE_TRIGGER,
+        'aperture_time': aperture_time,
+        'digital_edge_measure_trigger_input_terminal': measure_terminal_name,
+    })
     return
 
 
-# function to perform measurements
+# function to fetch the sweep results in batches while the sequence is running, every batch holds all
+# available records but at least points_per_update records, 0 fetches the whole sweep at once. Sweeps with fewer
+# points than points_per_update would only be fetched at the end, so they are fetched as the points are measured
 def perform_measurements(
         source_session: Session,
         source_device_channel: str,
         load_session: Session,
         load_device_channel: str,
-        voltage_values: list[float],
+        voltage_values: np.ndarray,
         nominal_output_voltage: float,
         load_voltage_vs_source_voltage: DoubleXYData,
         load_voltage_dev_vs_source_voltage: DoubleXYData,
+        source_delay: float,
+        aperture_time: float,
+        points_per_update: int
 ):
-    for _ in voltage_values:
-        source_measurement = source_session.channels[source_device_channel].fetch_multiple(
-            count=1, timeout=hightime.timedelta(seconds=0.1)
-        )[0]
-        load_measurement = load_session.channels[load_device_channel].fetch_multiple(
-            count=1, timeout=hightime.timedelta(seconds=0.1)
-        )[0]
-        source_voltage = source_measurement.voltage
-        load_voltage = load_measurement.voltage
-        load_voltage_vs_source_voltage.x_data.append(source_voltage)
-        load_voltage_vs_source_voltage.y_data.append(load_voltage)
-        load_voltage_dev_vs_source_voltage.x_data.append(source_voltage)
-        load_voltage_dev_vs_source_voltage.y_data.append(
-            (load_voltage-nominal_output_voltage)*100/nominal_output_voltage
+    total_points = len(voltage_values)
+    if points_per_update <= 0:
+        points_per_update = total_points
+    elif points_per_update > total_points:
+        points_per_update = 1
+    fetched_points = 0
+    while fetched_points < total_points:
+        remaining_points = total_points - fetched_points
+        count = min(
+            max(source_session.channels[source_device_channel].fetch_backlog, points_per_update),
+            remaining_points
         )
-        yield
+        # every sweep point takes the source delay and the aperture time, plus margin for the driver
+        timeout = hightime.timedelta(seconds=count * (source_delay + aperture_time) + 1.0)
+        with stage("fetch"):
+            source_measurements = source_session.channels[source_device_channel].fetch_multiple(
+                count=count, timeout=timeout
+            )
+            load_measurements = load_session.channels[load_device_channel].fetch_multiple(
+                count=count, timeout=timeout
+            )
+        with stage("processing"):
+            source_voltages = np.fromiter((measurement.voltage for measurement in source_measurements), np.float64,
+                                          count)
+            load_voltages = np.fromiter((measurement.voltage for measurement in load_measurements), np.float64, count)
+            extend_xy_data(load_voltage_vs_source_voltage, source_voltages, load_voltages)
+            extend_xy_data(
+                load_voltage_dev_vs_source_voltage,
+                source_voltages,
+                (load_voltages - nominal_output_voltage) * 100 / nominal_output_voltage
+            )
+        fetched_points += count
+        # only the new batch is yielded, the graphs hold the whole sweep
+        yield source_voltages, load_voltages
     return
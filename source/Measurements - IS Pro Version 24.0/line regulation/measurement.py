@@ -5,7 +5,12 @@ import sys
 import click
 import ni_measurementlink_service as nims
 
+from _helpers import OutputDelta, UpdateThrottle
+from _metrics import MeasurementMetrics, MetricsExporter
+from _result_log import FORMATS, ResultLog
+from _stage_timing import StageTimer, stage, timed_measurement
 from configure_dc_power import *
+from regulation_analysis import LineRegulationStatistics
 
 script_or_exe = sys.executable if getattr(sys, "frozen", False) else __file__
 service_directory = pathlib.Path(script_or_exe).resolve().parent
@@ -14,6 +19,8 @@ measurement_service = nims.MeasurementService(
     version="1.0.0.0",
     ui_file_paths=[service_directory / "LineRegulation_PMIC.measui"],
 )
+metrics = MeasurementMetrics('Line regulation')
+result_log = ResultLog(measurement_service, 'line_regulation')
 
 
 @measurement_service.register_measurement
@@ -25,6 +32,15 @@ measurement_service = nims.MeasurementService(
 # Aperture time is the period during which an ADC reads the voltage or current on a power supply or SMU
 @measurement_service.configuration('Aperture time (s)', nims.DataType.Double, 0.005)
 @measurement_service.configuration('Nominal output voltage (V)', nims.DataType.Double, 3.3)
+# Minimum number of sweep points fetched per result update, sweeps with fewer points are updated as the points are
+# measured. 0 updates the results once at the end of the sweep
+@measurement_service.configuration('Points per update', nims.DataType.Int32, 100)
+# Incremental updates send only the graph points added since the previous update, the final result is complete
+@measurement_service.configuration('Incremental updates', nims.DataType.Boolean, False)
+# Intermediate results are sent at most once per interval, 0 sends every update
+@measurement_service.configuration('Minimum update interval (s)', nims.DataType.Double, 0.0)
+# The time spent in every stage of the run is returned in the timing output, it is always logged with -v
+@measurement_service.configuration('Report timing', nims.DataType.Boolean, False)
 # Source Settings
 @measurement_service.configuration('Source resource name', nims.DataType.String, 'PPS')
 @measurement_service.configuration('Source current limit (A)', nims.DataType.Double, 25.0)
@@ -43,12 +59,24 @@ measurement_service = nims.MeasurementService(
 @measurement_service.output('Load voltage (V)', nims.DataType.Double)
 @measurement_service.output('Load voltage deviation (%)', nims.DataType.Double)
 @measurement_service.output('DUT status', nims.DataType.String)
+@measurement_service.output('Minimum load voltage (V)', nims.DataType.Double)
+@measurement_service.output('Maximum load voltage (V)', nims.DataType.Double)
+@measurement_service.output('Worst-case load voltage deviation (%)', nims.DataType.Double)
+@measurement_service.output('Line regulation (mV/V)', nims.DataType.Double)
+@measurement_service.output('Timing', nims.DataType.String)
+@result_log.instrument
+@metrics.instrument
+@timed_measurement
 def measure(
         mode_of_operation: Enum,
         dut_setup_time: float,
         source_delay: float,
         aperture_time: float,
         nominal_output_voltage: float,
+        points_per_update: int,
+        incremental_updates: bool,
+        minimum_update_interval: float,
+        report_timing: bool,
         source_resource_name: str,
         source_current_limit: float,
         sweep_type: Enum,
@@ -69,6 +97,12 @@ def measure(
     load_voltage: float = float()
     load_voltage_deviation: float = float()
     dut_status: str = ''
+    minimum_load_voltage: float = float()
+    maximum_load_voltage: float = float()
+    worst_load_voltage_deviation: float = float()
+    line_regulation: float = float()
+    timing: str = str()
+    timer = StageTimer('Line regulation')
     # Measure logic start
     if mode_of_operation == ModeOfOperation.Power_On_DUT:
         res = power_on_dut(source_resource_name, source_device_channel, source_start_voltage, source_current_limit)
@@ -76,8 +110,8 @@ def measure(
         pass
 
     elif mode_of_operation == ModeOfOperation.PerformMeasurement:
-        source_session = Session(source_resource_name, source_device_channel)
-        load_session = Session(load_resource_name, load_device_channel)
+        source_session = session_pool.acquire(source_resource_name, source_device_channel)
+        load_session = session_pool.acquire(load_resource_name, load_device_channel)
         try:
             voltage_values = generate_sequence(
                 sweep_type,
@@ -120,9 +154,9 @@ def measure(
                 build_trigger_terminal(source_resource_name, source_device_channel, 'SourceCompleteEvent')
             )
 
-            load_session.channels[load_device_channel].initiate()
-            source_session.channels[source_device_channel].initiate()
-            source_session.channels[source_device_channel].wait_for_event(event_id=Event.SEQUENCE_ITERATION_COMPLETE)
+            with stage('initiate'):
+                load_session.channels[load_device_channel].initiate()
+                source_session.channels[source_device_channel].initiate()
 
             gen = perform_measurements(
                 source_session,
@@ -132,24 +166,56 @@ def measure(
                 voltage_values,
                 nominal_output_voltage,
                 load_voltage_vs_source_voltage,
-                load_voltage_dev_vs_source_voltage
+                load_voltage_dev_vs_source_voltage,
+                source_delay,
+                aperture_time,
+                points_per_update
             )
 
-            for _ in gen:
-                load_voltage = sum(load_voltage_vs_source_voltage.y_data) / len(load_voltage_vs_source_voltage.y_data)
-                load_voltage_deviation = sum(load_voltage_dev_vs_source_voltage.y_data) / len(load_voltage_dev_vs_source_voltage.y_data)
-                yield (
-                    load_voltage_vs_source_voltage,
-                    load_voltage_dev_vs_source_voltage,
-                    load_voltage,
-                    load_voltage_deviation,
-                    dut_status,
-                )
+            statistics = LineRegulationStatistics(nominal_output_voltage)
+            update_throttle = UpdateThrottle(minimum_update_interval)
+            load_voltage_delta = OutputDelta()
+            load_voltage_dev_delta = OutputDelta()
+            for source_voltages, load_voltages in gen:
+                with stage('processing'):
+                    statistics.update(source_voltages, load_voltages)
+                    load_voltage = statistics.mean_load_voltage
+                    load_voltage_deviation = statistics.mean_deviation
+                    minimum_load_voltage = statistics.minimum
+                    maximum_load_voltage = statistics.maximum
+                    worst_load_voltage_deviation = statistics.worst_deviation
+                    line_regulation = statistics.line_regulation * 1000
+                if not update_throttle.due():
+                    continue
+                if report_timing:
+                    timing = timer.summary()
+                with stage('yield'):
+                    yield (
+                        load_voltage_delta(load_voltage_vs_source_voltage)
+                        if incremental_updates else load_voltage_vs_source_voltage,
+                        load_voltage_dev_delta(load_voltage_dev_vs_source_voltage)
+                        if incremental_updates else load_voltage_dev_vs_source_voltage,
+                        load_voltage,
+                        load_voltage_deviation,
+                        dut_status,
+                        minimum_load_voltage,
+                        maximum_load_voltage,
+                        worst_load_voltage_deviation,
+                        line_regulation,
+                        timing,
+                    )
 
             reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
             dut_status = 'The measurement is performed successfully'
+        except GeneratorExit:
+            # the client canceled the measurement, the sweep is stopped and the sessions go back to the pool
+            try:
+                reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            except Exception:
+                discard_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            raise
         except Exception:
-            reset_sessions(source_session, source_device_channel, load_session, load_device_channel)
+            discard_sessions(source_session, source_device_channel, load_session, load_device_channel)
             raise
         pass
 
@@ -158,12 +224,18 @@ def measure(
         dut_status = 'The DUT is powered off'
         pass
     # Measure logic end
+    timing = timer.finish()
     return (
         load_voltage_vs_source_voltage,
         load_voltage_dev_vs_source_voltage,
         load_voltage,
         load_voltage_deviation,
         dut_status,
+        minimum_load_voltage,
+        maximum_load_voltage,
+        worst_load_voltage_deviation,
+        line_regulation,
+        timing if report_timing else str(),
     )
 
 
@@ -174,7 +246,47 @@ def measure(
     count=True,
     help="Enable verbose logging. Repeat to increase verbosity.",
 )
-def main(verbose: int) -> None:
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=None,
+    help="Serve measurement metrics at http://127.0.0.1:PORT/metrics.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write measurement metrics to this file periodically.",
+)
+@click.option(
+    "--metrics-interval",
+    type=float,
+    default=10.0,
+    show_default=True,
+    help="Seconds between two writes of the metrics file.",
+)
+@click.option(
+    "--result-log",
+    "result_log_directory",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Log the configuration and results of every measurement run to files in this directory.",
+)
+@click.option(
+    "--result-log-format",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="File format of the result log, Parquet or Arrow IPC stream. Requires the pyarrow package.",
+)
+def main(
+    verbose: int,
+    metrics_port: int,
+    metrics_file: str,
+    metrics_interval: float,
+    result_log_directory: str,
+    result_log_format: str,
+) -> None:
     if verbose > 1:
         level = logging.DEBUG
     elif verbose == 1:
@@ -183,8 +295,12 @@ def main(verbose: int) -> None:
         level = logging.WARNING
     logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=level)
 
-    with measurement_service.host_service():
-        input("Press enter to close the measurement service.\n")
+    if result_log_directory:
+        result_log.start(result_log_directory, result_log_format)
+    with result_log, MetricsExporter(metrics, metrics_port, metrics_file, metrics_interval):
+        with measurement_service.host_service():
+            input("Press enter to close the measurement service.\n")
+    session_pool.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+"""Streaming analysis of line regulation sweeps that are fetched in batches."""
+
+import math
+
+import numpy as np
+
+
+class LineRegulationStatistics(object):
+    """Running summary of the load voltage over a source voltage sweep.
+
+    Besides the mean, minimum and maximum load voltage, the means and co-moments of the source and
+    load voltages are kept, so the line regulation (the slope of a least squares line through the
+    load voltage vs source voltage points) is available after every batch. The cost of an update
+    depends on the size of the new batch and not on the number of points fetched before.
+    """
+
+    def __init__(self, nominal_output_voltage: float) -> None:
+        """Initialize the statistics.
+
+        Args:
+            nominal_output_voltage: The expected output voltage that deviations are relative to.
+        """
+        self.nominal_output_voltage = nominal_output_voltage
+        self.count = 0
+        self.mean_source_voltage = 0.0
+        self.mean_load_voltage = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self._source_m2 = 0.0
+        self._co_moment = 0.0
+
+    def update(self, source_voltages, load_voltages) -> None:
+        """Add a batch of source and load voltage pairs to the statistics."""
+        x = np.asarray(source_voltages, dtype=np.float64)
+        y = np.asarray(load_voltages, dtype=np.float64)
+        if y.size == 0:
+            return
+        batch_mean_x = float(x.mean())
+        batch_mean_y = float(y.mean())
+        dx = x - batch_mean_x
+        # merge the batch moments into the running moments (Chan et al.), this stays accurate for long sweeps
+        count = self.count + y.size
+        delta_x = batch_mean_x - self.mean_source_voltage
+        delta_y = batch_mean_y - self.mean_load_voltage
+        weight = self.count * y.size / count
+        self._source_m2 += float(np.dot(dx, dx)) + delta_x * delta_x * weight
+        self._co_moment += float(np.dot(dx, y - batch_mean_y)) + delta_x * delta_y * weight
+        self.mean_source_voltage += delta_x * y.size / count
+        self.mean_load_voltage += delta_y * y.size / count
+        self.count = count
+        self.minimum = min(self.minimum, float(y.min()))
+        self.maximum = max(self.maximum, float(y.max()))
+
+    def deviation(self, load_voltage: float) -> float:
+        """Deviation of a load voltage from the nominal output voltage in percent."""
+        return (load_voltage - self.nominal_output_voltage) * 100 / self.nominal_output_voltage
+
+    @property
+    def mean_deviation(self) -> float:
+        """Mean deviation of the load voltage from the nominal output voltage in percent."""
+        return self.deviation(self.mean_load_voltage) if self.count else 0.0
+
+    @property
+    def worst_deviation(self) -> float:
+        """Deviation in percent of the load voltage that is farthest from the nominal output voltage."""
+        if not self.count:
+            return 0.0
+        return max(self.deviation(self.minimum), self.deviation(self.maximum), key=abs)
+
+    @property
+    def line_regulation(self) -> float:
+        """Change of the load voltage per change of the source voltage, in V/V."""
+        return self._co_moment / self._source_m2 if self._source_m2 > 0 else 0.0
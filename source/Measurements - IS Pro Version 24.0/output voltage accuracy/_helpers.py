@@ -2,9 +2,11 @@
 
 import logging
 import pathlib
-from typing import Any, Callable, TypeVar
+import time
+from typing import Any, Callable, Optional, TypeVar
 import numpy as np
 import click
+from ni_measurementlink_service._internal.stubs.ni.protobuf.types.xydata_pb2 import DoubleXYData
 
 
 class TestStandSupport(object):
@@ -81,6 +83,84 @@ def verbosity_option(func: F) -> F:
     )(func)
 
 
+def time_axis(start: float, x_increment: float, num_samples: int) -> np.ndarray:
+    """Return the time of each sample of a uniformly sampled waveform.
+
+    The time is computed from the sample index, so no rounding error accumulates over long waveforms.
+    """
+    return start + x_increment * np.arange(num_samples, dtype=np.float64)
+
+
+def extend_xy_data(xy_data: DoubleXYData, x_data: Any, y_data: Any) -> None:
+    """Append points to a DoubleXYData with one bulk extend per axis.
+
+    Args:
+        xy_data:
+            The graph to append the points to.
+        x_data, y_data:
+            Sequences or NumPy arrays of equal length.
+    """
+    x_values = np.asarray(x_data, dtype=np.float64)
+    y_values = np.asarray(y_data, dtype=np.float64)
+    if x_values.shape != y_values.shape:
+        raise ValueError(f"x and y data lengths differ: {x_values.size} != {y_values.size}")
+    # tolist() converts to Python floats in C, which the repeated fields take in a single call
+    xy_data.x_data.extend(x_values.tolist())
+    xy_data.y_data.extend(y_values.tolist())
+
+
+class UpdateThrottle(object):
+    """Limits how often a measurement yields intermediate results."""
+
+    def __init__(self, minimum_interval: float) -> None:
+        """Initialize the throttle.
+
+        Args:
+            minimum_interval: Minimum time in seconds between two updates. 0 allows every update.
+        """
+        self.minimum_interval = minimum_interval
+        self._last_update = None
+
+    def due(self) -> bool:
+        """Return whether an update is allowed now. An allowed update restarts the interval."""
+        now = time.monotonic()
+        if self._last_update is not None and now - self._last_update < self.minimum_interval:
+            return False
+        self._last_update = now
+        return True
+
+
+class OutputDelta(object):
+    """Cuts the points that were added to a growing output since the previous update.
+
+    Used for incremental updates, which send only the new points instead of the whole output.
+    """
+
+    def __init__(self) -> None:
+        self.points_sent = 0
+
+    def __call__(self, value: Any, total_points: Optional[int] = None) -> Any:
+        """Return the new points of a DoubleXYData, list or array.
+
+        Args:
+            value:
+                The current value of the output.
+            total_points:
+                Number of points added to the output so far. Defaults to the length of the output,
+                pass it for outputs that drop their oldest points.
+        """
+        length = len(value.y_data) if isinstance(value, DoubleXYData) else len(value)
+        total_points = length if total_points is None else total_points
+        start = length - min(max(total_points - self.points_sent, 0), length)
+        self.points_sent = total_points
+        if isinstance(value, DoubleXYData):
+            delta = DoubleXYData()
+            delta.x_data.extend(value.x_data[start:])
+            delta.y_data.extend(value.y_data[start:])
+            return delta
+        return value[start:]
+
+
 def calculate_pk_to_pk(signal):
     return np.max(signal) - np.min(signal)
 
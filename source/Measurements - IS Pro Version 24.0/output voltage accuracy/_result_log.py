@@ -0,0 +1,408 @@
+"""Asynchronous logging of measurement results to columnar files."""
+
+import datetime
+import functools
+import inspect
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import warnings
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+_logger = logging.getLogger(__name__)
+
+FORMATS = ("parquet", "arrow")
+_FILE_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrows"}
+# google.protobuf.Field.Kind values of the measurement parameters
+_TYPE_BOOL = 8
+_TYPE_STRING = 9
+_TYPE_ENUM = 14
+_INTEGER_TYPES = (3, 4, 5, 6, 7, 13, 15, 16, 17, 18)
+# log files of the runs, the waveforms are logged to one set of files per table name
+_RUNS = "runs"
+_STOP = object()
+
+# the run that is logged on a thread, set while the measure function executes
+_active = threading.local()
+
+
+class _Run(NamedTuple):
+    """A finished measurement run on the queue."""
+
+    run_id: str
+    started: float
+    duration: float
+    configuration: tuple
+    outputs: tuple
+
+
+class _Waveforms(NamedTuple):
+    """The samples of several channels that a run acquired, on the queue."""
+
+    table: str
+    run_id: str
+    logged: float
+    channel_names: tuple
+    first_sample: int
+    x_increment: float
+    samples: np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.samples.nbytes
+
+
+class _ActiveRun(object):
+    """Id of a run that is executing and the number of samples it logged per table and channel."""
+
+    def __init__(self) -> None:
+        self.run_id = uuid.uuid4().hex
+        self.samples_logged: Dict[str, int] = {}
+
+
+class ResultLog(object):
+    """Appends the configuration and the results of every measurement run to columnar files.
+
+    Decorate the measure function with instrument(). The measurement thread only puts the values of
+    a finished run on a bounded queue and never waits for the disk. A background thread converts
+    the runs to Arrow columns in batches and appends each batch to a Parquet file (one row group
+    per batch) or an Arrow IPC stream file. A new file is started every rows_per_file rows, a
+    Parquet file is only readable after it is closed. If the queue is full, the run is not logged.
+
+    Scalars are stored as they are, enums by name, arrays as lists and DoubleXYData as two list
+    columns "<name> x" and "<name> y". Configuration columns are prefixed with "configuration: "
+    and every row starts with the id, the timestamp and the duration of the run.
+
+    The raw samples that a run acquires while it executes are logged with log_waveforms(), one row
+    per channel and call in a separate set of files per table name, linked to the run by its id.
+    """
+
+    def __init__(
+        self,
+        measurement_service: Any,
+        service_name: str,
+        batch_size: int = 256,
+        flush_interval: float = 5.0,
+        rows_per_file: int = 100000,
+        queue_size: int = 1024,
+        max_queued_bytes: int = 256 * 2 ** 20,
+    ) -> None:
+        """Initialize the result log.
+
+        Args:
+            measurement_service: The service whose configuration and output parameters are logged.
+            service_name: File name prefix of the log files.
+            batch_size: Maximum number of runs and waveforms written at once.
+            flush_interval: Maximum time in seconds a run waits on the queue before it is written.
+            rows_per_file: Number of rows after which a new file is started.
+            queue_size: Maximum number of runs and waveforms waiting to be written.
+            max_queued_bytes: Maximum size of the waveform samples waiting to be written.
+        """
+        self.measurement_service = measurement_service
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_per_file = rows_per_file
+        self.max_queued_bytes = max_queued_bytes
+        self.directory: Optional[str] = None
+        self.file_format = FORMATS[0]
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._columns: List[tuple] = []
+        self._schemas: Dict[str, Any] = {}
+        self._writers: Dict[str, Any] = {}
+        self._file_rows: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the results are logged."""
+        return self._thread is not None
+
+    def start(self, directory: str, file_format: str = FORMATS[0]) -> None:
+        """Start logging the results to files in a directory.
+
+        Args:
+            directory: Directory of the log files, it is created if it does not exist.
+            file_format: "parquet" or "arrow" (Arrow IPC stream).
+        """
+        if pyarrow is None:
+            raise RuntimeError("Logging the results requires the pyarrow package: pip install pyarrow")
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown result log format '{file_format}', use one of {', '.join(FORMATS)}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.file_format = file_format
+        self._columns = self._parameter_columns()
+        self._schemas = {_RUNS: pyarrow.schema([(name, arrow_type) for name, arrow_type, _ in self._columns])}
+        self._thread = threading.Thread(target=self._write_loop, name="result log", daemon=True)
+        self._thread.start()
+        _logger.info("Logging the results to %s", directory)
+
+    def close(self) -> None:
+        """Write the queued runs, close the log files and stop the background thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        if self.dropped:
+            _logger.warning("%d measurement runs or waveforms were not logged, the result log queue was full.",
+                            self.dropped)
+
+    def __enter__(self) -> "ResultLog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def instrument(self, measure_function: Callable) -> Callable:
+        """Decorator that logs the runs of a measure function, keeps its signature for the service."""
+        signature = inspect.signature(measure_function)
+
+        @functools.wraps(measure_function)
+        def measure(*args, **kwargs):
+            if self._thread is None:
+                return measure_function(*args, **kwargs)
+            started = time.time()
+            configuration = tuple(signature.bind(*args, **kwargs).arguments.values())
+            run = _ActiveRun()
+            _active.run = run
+            try:
+                result = measure_function(*args, **kwargs)
+            finally:
+                _active.run = None
+            if not hasattr(result, "send"):
+                self._log(run, started, configuration, result)
+                return result
+            return self._generator(result, run, started, configuration)
+
+        return measure
+
+    def log_waveforms(
+        self, table: str, channel_names: Sequence[str], samples: np.ndarray, x_increment: float
+    ) -> None:
+        """Log the samples that the executing run acquired, does nothing if the results are not logged.
+
+        Every call appends one row per channel to the files of the table, with the index of its first
+        sample in the run. The samples are copied, so the caller can reuse its buffer after the call.
+
+        Args:
+            table: Name of the table, the files are named "<service>-<table>-<time>".
+            channel_names: Name of every channel, in the order of the rows of samples.
+            samples: A (channels x samples) array.
+            x_increment: Time between two samples in seconds.
+        """
+        run = getattr(_active, "run", None)
+        if run is None or self._thread is None:
+            return
+        first_sample = run.samples_logged.get(table, 0)
+        waveforms = _Waveforms(table, run.run_id, time.time(), tuple(channel_names), first_sample, x_increment,
+                               np.array(samples, dtype=np.float64))
+        run.samples_logged[table] = first_sample + waveforms.samples.shape[1]
+        with self._lock:
+            if self._queued_bytes + waveforms.nbytes > self.max_queued_bytes:
+                self._drop()
+                return
+            self._queued_bytes += waveforms.nbytes
+        self._put(waveforms)
+
+    def _generator(self, generator, run: _ActiveRun, started: float, configuration: tuple):
+        # canceled and failed runs raise out of the yield from and are not logged, the waveforms that they
+        # logged before stay in the waveform tables
+        _active.run = run
+        try:
+            outputs = yield from generator
+        finally:
+            _active.run = None
+        if outputs is not None:
+            self._log(run, started, configuration, outputs)
+        return outputs
+
+    def _log(self, run: _ActiveRun, started: float, configuration: tuple, outputs: tuple) -> None:
+        # the outputs of a finished run are not modified any more, so they are queued without a copy
+        self._put(_Run(run.run_id, started, time.time() - started, configuration, outputs))
+
+    def _put(self, item: Any) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if isinstance(item, _Waveforms):
+                with self._lock:
+                    self._queued_bytes -= item.nbytes
+            self._drop()
+
+    def _drop(self) -> None:
+        if not self.dropped:
+            _logger.warning("The result log cannot keep up, measurement runs or waveforms are not logged.")
+        self.dropped += 1
+
+    def _parameter_columns(self) -> List[tuple]:
+        # (column name, Arrow type, function that gets the column value of a run) in schema order
+        configuration_parameters, output_parameters = _parameter_metadata(self.measurement_service)
+        columns = [
+            ("run id", pyarrow.string(), lambda run: run.run_id),
+            ("timestamp", pyarrow.timestamp("us", tz="UTC"),
+             lambda run: datetime.datetime.fromtimestamp(run.started, datetime.timezone.utc)),
+            ("duration (s)", pyarrow.float64(), lambda run: run.duration),
+        ]
+        for index, parameter in enumerate(configuration_parameters):
+            columns.extend(_columns(
+                "configuration: " + parameter.display_name, parameter, lambda run, index=index: run.configuration[index]
+            ))
+        for index, parameter in enumerate(output_parameters):
+            columns.extend(_columns(parameter.display_name, parameter, lambda run, index=index: run.outputs[index]))
+        return columns
+
+    def _write_loop(self) -> None:
+        items: list = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None and item is not _STOP:
+                items.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if items and (item is None or item is _STOP or len(items) >= self.batch_size):
+                self._write_items(items)
+                items = []
+                deadline = None
+            if item is _STOP:
+                for table in list(self._writers):
+                    self._close_file(table)
+                return
+
+    def _write_items(self, items: list) -> None:
+        runs = [item for item in items if isinstance(item, _Run)]
+        waveforms: Dict[str, list] = {}
+        for item in items:
+            if isinstance(item, _Waveforms):
+                waveforms.setdefault(item.table, []).append(item)
+        if runs:
+            try:
+                self._write(_RUNS, self._runs_batch(runs))
+            except Exception:
+                _logger.exception("Cannot log %d measurement runs.", len(runs))
+        for table, table_waveforms in waveforms.items():
+            try:
+                self._write(table, _waveforms_batch(table_waveforms))
+            except Exception:
+                _logger.exception("Cannot log %d waveforms to %s.", len(table_waveforms), table)
+            finally:
+                with self._lock:
+                    self._queued_bytes -= sum(item.nbytes for item in table_waveforms)
+
+    def _runs_batch(self, runs: list):
+        arrays = [
+            pyarrow.array([value(run) for run in runs], type=arrow_type) for _, arrow_type, value in self._columns
+        ]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self._schemas[_RUNS])
+
+    def _write(self, table: str, batch) -> None:
+        if table not in self._writers:
+            self._open_file(table, batch.schema)
+        self._writers[table].write_batch(batch)
+        self._file_rows[table] += batch.num_rows
+        if self._file_rows[table] >= self.rows_per_file:
+            self._close_file(table)
+
+    def _open_file(self, table: str, schema) -> None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        prefix = self.service_name if table == _RUNS else f"{self.service_name}-{table}"
+        path = os.path.join(self.directory, f"{prefix}-{timestamp}{_FILE_EXTENSIONS[self.file_format]}")
+        if self.file_format == "parquet":
+            self._writers[table] = pyarrow.parquet.ParquetWriter(path, schema)
+        else:
+            self._writers[table] = pyarrow.ipc.new_stream(path, schema)
+        self._file_rows[table] = 0
+
+    def _close_file(self, table: str) -> None:
+        writer = self._writers.pop(table, None)
+        if writer is not None:
+            writer.close()
+
+
+def _parameter_metadata(measurement_service: Any) -> tuple:
+    # the configuration and output parameters of the service in the order of the measure arguments and
+    # outputs. ni_measurementlink_service 1.3 and later mark the properties as deprecated
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return measurement_service.configuration_parameter_list, measurement_service.output_parameter_list
+
+
+def _waveforms_batch(waveforms: list):
+    # one row per channel, the samples of all rows are one contiguous values buffer of the list column
+    channel_counts = [len(item.channel_names) for item in waveforms]
+    lengths = np.repeat([item.samples.shape[1] for item in waveforms], channel_counts)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate([item.samples.ravel() for item in waveforms])
+    return pyarrow.RecordBatch.from_arrays(
+        [
+            pyarrow.array(np.repeat([item.run_id for item in waveforms], channel_counts), type=pyarrow.string()),
+            pyarrow.array(
+                np.repeat([int(item.logged * 1e6) for item in waveforms], channel_counts),
+                type=pyarrow.timestamp("us", tz="UTC")
+            ),
+            pyarrow.array([name for item in waveforms for name in item.channel_names], type=pyarrow.string()),
+            pyarrow.array(np.repeat([item.first_sample for item in waveforms], channel_counts), type=pyarrow.int64()),
+            pyarrow.array(np.repeat([item.x_increment for item in waveforms], channel_counts), type=pyarrow.float64()),
+            pyarrow.ListArray.from_arrays(pyarrow.array(offsets), pyarrow.array(values)),
+        ],
+        names=["run id", "timestamp", "channel", "first sample", "x increment (s)", "samples"],
+    )
+
+
+def _arrow_type(parameter: Any):
+    if parameter.type == _TYPE_BOOL:
+        arrow_type = pyarrow.bool_()
+    elif parameter.type in (_TYPE_STRING, _TYPE_ENUM):
+        arrow_type = pyarrow.string()
+    elif parameter.type in _INTEGER_TYPES:
+        arrow_type = pyarrow.int64()
+    else:
+        arrow_type = pyarrow.float64()
+    return pyarrow.list_(arrow_type) if parameter.repeated else arrow_type
+
+
+def _columns(name: str, parameter: Any, value: Callable[[_Run], Any]) -> List[tuple]:
+    # the columns of one parameter, value gets the parameter value of a run
+    if parameter.message_type.endswith("DoubleXYData"):
+        if parameter.repeated:
+            arrow_type = pyarrow.list_(pyarrow.list_(pyarrow.float64()))
+            return [
+                (f"{name} x", arrow_type, lambda run: [list(graph.x_data) for graph in value(run)]),
+                (f"{name} y", arrow_type, lambda run: [list(graph.y_data) for graph in value(run)]),
+            ]
+        arrow_type = pyarrow.list_(pyarrow.float64())
+        return [
+            (f"{name} x", arrow_type, lambda run: list(value(run).x_data)),
+            (f"{name} y", arrow_type, lambda run: list(value(run).y_data)),
+        ]
+    if parameter.type == _TYPE_ENUM:
+        if parameter.repeated:
+            return [(name, _arrow_type(parameter), lambda run: [_enum_name(item) for item in value(run)])]
+        return [(name, _arrow_type(parameter), lambda run: _enum_name(value(run)))]
+    return [(name, _arrow_type(parameter), value)]
+
+
+def _enum_name(value: Any) -> str:
+    return getattr(value, "name", str(value))
@@ -0,0 +1,244 @@
+"""Keyed pool of NI-DCPower sessions that stay open between measurement runs."""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import nidcpower
+
+from _stage_timing import stage
+
+_logger = logging.getLogger(__name__)
+
+# Sessions that have not been used for this many seconds are closed on the next pool access.
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+
+class _PooledSession(object):
+    """A pooled session together with its channel and bookkeeping data."""
+
+    def __init__(self, key: Tuple[str, str], session: nidcpower.Session) -> None:
+        self.key = key
+        self.session = session
+        self.channel_name = key[1]
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        # last committed property values per channel name, see DCPowerSessionPool.configure()
+        self.configuration: Dict[str, Dict[str, Any]] = {}
+
+
+class DCPowerSessionPool(object):
+    """Pool of NI-DCPower sessions keyed by resource name and channel."""
+
+    def __init__(
+        self,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        session_factory: Optional[Callable[..., nidcpower.Session]] = None,
+    ) -> None:
+        """Initialize the session pool.
+
+        Args:
+            idle_timeout:
+                Time in seconds after which a released session that has not been acquired
+                again is closed.
+            session_factory:
+                Callable used to open new sessions. Defaults to nidcpower.Session.
+        """
+        self.idle_timeout = idle_timeout
+        self._session_factory = session_factory
+        self._entries: Dict[Tuple[str, str], _PooledSession] = {}
+        self._lock = threading.RLock()
+        self._eviction_timer: Optional[threading.Timer] = None
+
+    def acquire(self, resource_name: str, channel_name: str) -> nidcpower.Session:
+        """Get the session for a resource and channel, opening it if it is not pooled yet.
+
+        Args:
+            resource_name: The NI-DCPower resource name.
+            channel_name: The channel of the resource to open the session on.
+
+        Returns:
+            An open session. Return it with release() or discard() when done.
+        """
+        with self._lock:
+            self.evict_idle()
+            key = (resource_name, channel_name)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._close_overlapping(resource_name, channel_name)
+                factory = self._session_factory or nidcpower.Session
+                _logger.debug("Opening NI-DCPower session for %s/%s.", resource_name, channel_name)
+                with stage("session open"):
+                    entry = _PooledSession(key, factory(resource_name=resource_name, channels=channel_name))
+                self._entries[key] = entry
+            entry.in_use += 1
+            entry.last_used = time.monotonic()
+            return entry.session
+
+    def release(self, session: nidcpower.Session) -> None:
+        """Return a session to the pool and keep it open for the next run."""
+        with self._lock:
+            entry = self._find(session)
+            if entry is None:
+                return
+            entry.in_use = max(entry.in_use - 1, 0)
+            entry.last_used = time.monotonic()
+            self.evict_idle()
+            self._schedule_eviction()
+
+    def discard(self, session: nidcpower.Session) -> None:
+        """Disable the output, reset and close a session and drop it from the pool.
+
+        Use this after an error so the next acquire() starts from a fresh driver session.
+        Discarding a session that is no longer pooled does nothing.
+        """
+        with self._lock:
+            entry = self._find(session)
+            if entry is None:
+                return
+            del self._entries[entry.key]
+        try:
+            session.channels[entry.channel_name].output_enabled = False
+            session.channels[entry.channel_name].reset()
+        finally:
+            session.close()
+
+    def configure(
+        self,
+        session: nidcpower.Session,
+        channel_name: str,
+        properties: Dict[str, Any],
+        commit: bool = True,
+    ) -> bool:
+        """Write the channel properties that changed since they were last configured and commit them.
+
+        The pool remembers the configured values per session and channel, so a repeated run with the
+        same settings writes nothing and skips the commit. The remembered values are dropped when the
+        session is discarded or closed; call invalidate() after anything else changes the properties,
+        such as reset() or direct property writes.
+
+        Args:
+            session: A session acquired from the pool.
+            channel_name: The channel or channel list to configure.
+            properties: Property names and values, written in this order.
+            commit: Whether to commit the written properties. Pass False if the caller commits after
+                further configuration.
+
+        Returns:
+            Whether any property was written.
+        """
+        with self._lock:
+            entry = self._find(session)
+            configured = entry.configuration.setdefault(channel_name, {}) if entry is not None else {}
+            changes = {
+                name: value for name, value in properties.items()
+                if name not in configured or configured[name] != value
+            }
+        if not changes:
+            return False
+        channels = session.channels[channel_name]
+        try:
+            with stage("configure"):
+                for name, value in changes.items():
+                    setattr(channels, name, value)
+            if commit:
+                with stage("commit"):
+                    channels.commit()
+        except Exception:
+            self.invalidate(session, channel_name)
+            raise
+        with self._lock:
+            configured.update(changes)
+        return True
+
+    def invalidate(
+        self,
+        session: nidcpower.Session,
+        channel_name: Optional[str] = None,
+        property_names: Optional[Iterable[str]] = None,
+    ) -> None:
+        """Forget configured property values, so the next configure() writes them again.
+
+        Args:
+            session: A session acquired from the pool.
+            channel_name: The channel or channel list whose values are forgotten, including
+                every channel list that shares a channel with it. None forgets all channels.
+            property_names: The properties to forget. None forgets all properties.
+        """
+        with self._lock:
+            entry = self._find(session)
+            if entry is None:
+                return
+            channels = _channel_set(channel_name) if channel_name is not None else set()
+            for configured_channel, configured in entry.configuration.items():
+                other_channels = _channel_set(configured_channel)
+                if channel_name is not None and channels and other_channels and not channels & other_channels:
+                    continue
+                if property_names is None:
+                    configured.clear()
+                else:
+                    for name in property_names:
+                        configured.pop(name, None)
+
+    def evict_idle(self) -> None:
+        """Close sessions that are not in use and have been idle longer than the idle timeout."""
+        with self._lock:
+            now = time.monotonic()
+            for entry in list(self._entries.values()):
+                if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                    _logger.debug("Closing idle NI-DCPower session for %s/%s.", *entry.key)
+                    del self._entries[entry.key]
+                    entry.session.close()
+
+    def close_all(self) -> None:
+        """Close every pooled session. The outputs keep their current state."""
+        with self._lock:
+            if self._eviction_timer is not None:
+                self._eviction_timer.cancel()
+                self._eviction_timer = None
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.session.close()
+
+    def _schedule_eviction(self) -> None:
+        # closes idle sessions even when no further runs arrive to trigger evict_idle()
+        if self._entries and (self._eviction_timer is None or not self._eviction_timer.is_alive()):
+            self._eviction_timer = threading.Timer(max(self.idle_timeout, 0.0) + 1.0, self._on_eviction_timer)
+            self._eviction_timer.daemon = True
+            self._eviction_timer.start()
+
+    def _on_eviction_timer(self) -> None:
+        with self._lock:
+            self._eviction_timer = None
+            self.evict_idle()
+            self._schedule_eviction()
+
+    def _close_overlapping(self, resource_name: str, channel_name: str) -> None:
+        # a channel belongs to one session at a time, so idle sessions that share a channel with a new
+        # session, for example "0" and "0,1", are closed before the new session is opened
+        channels = _channel_set(channel_name)
+        for entry in list(self._entries.values()):
+            if entry.key[0] != resource_name or entry.in_use:
+                continue
+            other_channels = _channel_set(entry.channel_name)
+            if not channels or not other_channels or channels & other_channels:
+                _logger.debug("Closing NI-DCPower session for %s/%s, it shares channels with %s.",
+                              resource_name, entry.channel_name, channel_name)
+                del self._entries[entry.key]
+                entry.session.close()
+
+    def _find(self, session: nidcpower.Session) -> Optional[_PooledSession]:
+        for entry in self._entries.values():
+            if entry.session is session:
+                return entry
+        return None
+
+
+def _channel_set(channel_name: str) -> set:
+    # an empty channel name stands for all channels of the resource
+    return {channel.strip() for channel in str(channel_name).split(",") if channel.strip()}
+
+
+session_pool = DCPowerSessionPool()
@@ -0,0 +1,63 @@
+"""Statistics of the output voltage record of the output voltage accuracy measurement."""
+
+from typing import NamedTuple
+
+import numpy as np
+
+# Percentiles of the output voltage record that are reported, in percent
+PERCENTILES = (1.0, 5.0, 50.0, 95.0, 99.0)
+
+
+class OutputVoltageStatistics(NamedTuple):
+    """Summary of an output voltage record."""
+
+    mean: float
+    accuracy: float
+    accuracy_percent: float
+    standard_deviation: float
+    minimum: float
+    maximum: float
+    pk_to_pk: float
+    percentiles: list
+    drift: float
+
+
+def analyze_output_voltage(voltages: np.ndarray, dt: float, nominal_output_voltage: float) -> OutputVoltageStatistics:
+    """Compute the statistics of a uniformly sampled output voltage record with NumPy.
+
+    Args:
+        voltages: The output voltage record.
+        dt: Time between two records in seconds.
+        nominal_output_voltage: The expected output voltage the accuracy is relative to.
+
+    Returns:
+        The statistics. The accuracy is the absolute difference between the mean and the nominal
+        output voltage, the drift is the slope of a least squares line through the record in V/s.
+    """
+    voltages = np.asarray(voltages, dtype=np.float64)
+    if voltages.size == 0:
+        return OutputVoltageStatistics(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, [0.0] * len(PERCENTILES), 0.0)
+    mean = float(voltages.mean())
+    deviations = voltages - mean
+    minimum = float(voltages.min())
+    maximum = float(voltages.max())
+    accuracy = abs(mean - nominal_output_voltage)
+
+    drift = 0.0
+    if voltages.size > 1:
+        # record index relative to the middle of the record, the least squares slope of evenly spaced points
+        centered_index = np.arange(voltages.size, dtype=np.float64) - (voltages.size - 1) / 2
+        index_variance = voltages.size * (voltages.size ** 2 - 1) / 12
+        drift = float(np.dot(centered_index, deviations)) / index_variance / dt
+
+    return OutputVoltageStatistics(
+        mean=mean,
+        accuracy=accuracy,
+        accuracy_percent=accuracy / nominal_output_voltage * 100,
+        standard_deviation=float(np.sqrt(np.dot(deviations, deviations) / voltages.size)),
+        minimum=minimum,
+        maximum=maximum,
+        pk_to_pk=maximum - minimum,
+        percentiles=np.percentile(voltages, PERCENTILES).tolist(),
+        drift=drift,
+    )
@@ -1,4 +1,45 @@
+import contextlib
+
+import hightime
 import nidcpower
+import numpy as np
+
+from _session_pool import session_pool
+from _stage_timing import stage
+
+# Number of records fetched per blocking fetch of a voltage record
+FETCH_CHUNK_SIZE = 1000
+# Time in seconds allowed per record on top of the aperture time when fetching, for the measurement overhead of the
+# instrument
+RECORD_TIMEOUT_HEADROOM = 0.001
+
+
+# function to pair load resource names and channels to rails, both are comma separated lists. A single resource name
+# or channel applies to every rail, for example resource "E-load" with channels "0,1,2" or resources "E1,E2" with
+# channel "0"
+def parse_load_rails(resource_names: str, channel_names: str) -> list[tuple[str, str]]:
+    resources = [name.strip() for name in resource_names.split(",") if name.strip()]
+    channels = [name.strip() for name in channel_names.split(",") if name.strip()]
+    if not resources or not channels:
+        raise ValueError("At least one load resource name and channel name is required.")
+    if len(resources) == 1:
+        resources = resources * len(channels)
+    elif len(channels) == 1:
+        channels = channels * len(resources)
+    elif len(resources) != len(channels):
+        raise ValueError(f"{len(resources)} load resource names do not match {len(channels)} load channel names.")
+    rails = list(zip(resources, channels))
+    if len(set(rails)) != len(rails):
+        raise ValueError("Every load channel can be used for one rail only.")
+    return rails
+
+
+# function to group rails by load resource, every resource is opened as one session on a channel list such as "0,1,2"
+def group_rails(rails: list[tuple[str, str]]) -> dict[str, str]:
+    channels = {}
+    for resource_name, channel_name in rails:
+        channels.setdefault(resource_name, []).append(channel_name)
+    return {resource_name: ",".join(channel_names) for resource_name, channel_names in channels.items()}
 
 
 # function to configure source SMU
@@ -10,30 +51,26 @@ def open_and_configure_dcpower_source(
         dut_setup_time: float,
         aperture_time: float
 ):
-    # Open the session
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    # Get the session from the pool, it is opened on first use
+    session = session_pool.acquire(resource_name, channel_name)
     try:
-        # configure the session
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_VOLTAGE
-
-        session.channels[channel_name].voltage_level = voltage_level
-        session.channels[channel_name].current_limit = current_limit
-
-        session.channels[channel_name].voltage_level_autorange = True
-        session.channels[channel_name].current_limit_autorange = True
-        session.channels[channel_name].source_delay = dut_setup_time
-        session.channels[channel_name].aperture_time = aperture_time
-        session.channels[channel_name].measure_when = nidcpower.MeasureWhen.ON_DEMAND
-
-        session.channels[channel_name].commit()
+        # configure the session, only the properties that changed since the previous run are written and committed
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_VOLTAGE,
+            'voltage_level': voltage_level,
+            'current_limit': current_limit,
+            'voltage_level_autorange': True,
+            'current_limit_autorange': True,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.ON_DEMAND,
+        })
         return session
 
     except nidcpower.Error:
-        session.output_enabled = False
-        session.reset()
-        session.close()
+        session_pool.discard(session)
         raise
 
 
@@ -46,85 +83,112 @@ def open_and_configure_dcpower_load(
         dut_setup_time: float,
         aperture_time: float
 ):
-    # Open the session
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    # Get the session from the pool, it is opened on first use
+    session = session_pool.acquire(resource_name, channel_name)
     try:
-
-        # configure the session
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_CURRENT
-
-        session.configure_aperture_time(aperture_time, units=nidcpower.ApertureTimeUnits.SECONDS)
-
-        session.channels[channel_name].current_level = current_level
-        session.channels[channel_name].current_level_autorange = True
-        session.channels[channel_name].voltage_limit_range = voltage_limit_range
-        session.channels[channel_name].source_delay = dut_setup_time
-        session.channels[channel_name].aperture_time = aperture_time
-        session.channels[channel_name].measure_when = nidcpower.MeasureWhen.ON_DEMAND
-
-        session.channels[channel_name].commit()
+        # configure the session, only the properties that changed since the previous run are written and committed.
+        # The load measures the voltage records right after sourcing, see measure_voltages
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_CURRENT,
+            'aperture_time_units': nidcpower.ApertureTimeUnits.SECONDS,
+            'current_level': current_level,
+            'current_level_autorange': True,
+            'voltage_limit_range': voltage_limit_range,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.AUTOMATICALLY_AFTER_SOURCE_COMPLETE,
+        })
         return session
 
     except nidcpower.Error:
-        session.output_enabled = False
-        session.reset()
-        session.close()
+        session_pool.discard(session)
         raise
 
 
 # function to measure dc power levels
-def measure_dcpower(session: nidcpower.Session, channel_name: str):
+def measure_dcpower(session: nidcpower.Session, channel_name: str, dut_setup_time: float):
     try:
 
-        with session.channels[channel_name].initiate():
-            session.channels[channel_name].wait_for_event(event_id=nidcpower.Event.SOURCE_COMPLETE, timeout=5)
-            measurements = session.channels[channel_name].measure_multiple()
+        with stage("initiate"):
+            acquisition = session.channels[channel_name].initiate()
+        with acquisition:
+            with stage("DUT setup"):
+                session.channels[channel_name].wait_for_event(event_id=nidcpower.Event.SOURCE_COMPLETE,
+                                                              timeout=dut_setup_time + 5)
+            with stage("measure"):
+                measurements = session.channels[channel_name].measure_multiple()
 
         measurement = measurements[0]
         result = [measurement.voltage, measurement.current, session]
         return result
 
     except nidcpower.Error:
-        session.output_enabled = False
-        session.reset()
-        session.close()
+        session_pool.discard(session)
         raise
 
 
-# function to measure multiple voltage points
-def measure_voltage(session: nidcpower.Session, channel_name: str, no_of_samples_to_fetch: int):
+# function to measure the voltage records of several rails at the same time. load_sessions maps every load resource
+# name to its session and rails lists the (resource name, channel) pair of every rail. All sessions are initiated
+# before the first fetch, so the records of all rails cover the same time window. Every fetch waits for a full chunk
+# of records and the voltages are copied from the driver buffer into a preallocated array with one row per rail. The
+# source session that powers the rails is discarded together with the load sessions if a driver error occurs
+def measure_voltages(
+        source_session: nidcpower.Session,
+        load_sessions: dict,
+        rails: list[tuple[str, str]],
+        no_of_samples_to_fetch: int,
+        aperture_time: float,
+        dut_setup_time: float,
+        chunk_size: int = FETCH_CHUNK_SIZE
+) -> np.ndarray:
     try:
-        session.measure_record_length = no_of_samples_to_fetch
-        session.measure_record_length_is_finite = True
-        session.channels[channel_name].measure_when = nidcpower.MeasureWhen.AUTOMATICALLY_AFTER_SOURCE_COMPLETE
-        session.commit()
-
-        volts = []
-        with session.channels[channel_name].initiate():
+        channel_lists = group_rails(rails)
+        for resource_name, channel_list in channel_lists.items():
+            session_pool.configure(load_sessions[resource_name], channel_list, {
+                'measure_record_length': no_of_samples_to_fetch,
+                'measure_record_length_is_finite': True,
+                'measure_when': nidcpower.MeasureWhen.AUTOMATICALLY_AFTER_SOURCE_COMPLETE,
+            })
+
+        volts = np.empty((len(rails), no_of_samples_to_fetch), dtype=np.float64)
+        with contextlib.ExitStack() as initiated_sessions:
+            with stage("initiate"):
+                for resource_name, channel_list in channel_lists.items():
+                    initiated_sessions.enter_context(load_sessions[resource_name].channels[channel_list].initiate())
 
             samples_acquired = 0
             while samples_acquired < no_of_samples_to_fetch:
-                measurements = session.channels[channel_name].fetch_multiple(count=session.fetch_backlog)
-                samples_acquired += len(measurements)
-
-                for i in range(len(measurements)):
-                    volts.append(measurements[i].voltage)
+                count = min(chunk_size, no_of_samples_to_fetch - samples_acquired)
+                for rail, (resource_name, channel_name) in enumerate(rails):
+                    # the first records also wait for the source delay, which is the DUT setup time. fetch_multiple
+                    # creates a Measurement tuple per record, the driver call behind it returns the voltages as one
+                    # array
+                    with stage("fetch"):
+                        voltages, _, _ = load_sessions[resource_name].channels[channel_name]._fetch_multiple(
+                            hightime.timedelta(
+                                seconds=dut_setup_time + count * (aperture_time + RECORD_TIMEOUT_HEADROOM) + 1.0
+                            ),
+                            count
+                        )
+                    with stage("processing"):
+                        volts[rail, samples_acquired:samples_acquired + count] = voltages
+                samples_acquired += count
 
         return volts
 
     except nidcpower.Error:
-        session.output_enabled = False
-        session.reset()
-        session.close()
+        for session in load_sessions.values():
+            session_pool.discard(session)
+        session_pool.discard(source_session)
         raise
 
 
-# function to close dc power session
+# function to close dc power session, the session itself stays open in the pool for the next run
 def close_dcpower(session: nidcpower.Session, channel_name: str):
     session.channels[channel_name].abort()
-    session.close()
+    session_pool.release(session)
 
 
 # function to configure source SMU
@@ -132,33 +196,34 @@ def power_on_dut(
         resource_name: str,
         channel_name: str,
         voltage_level: float,
-        current_limit: float
+        current_limit: float,
+        dut_setup_time: float,
+        aperture_time: float
 ):
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    session = session_pool.acquire(resource_name, channel_name)
     try:
         # configure the session
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_VOLTAGE
-
-        session.channels[channel_name].voltage_level = voltage_level
-        session.channels[channel_name].current_limit = current_limit
-
-        session.channels[channel_name].voltage_level_autorange = True
-        session.channels[channel_name].current_limit_autorange = True
-
-        session.channels[channel_name].commit()
-        result = measure_dcpower(session, channel_name)
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_VOLTAGE,
+            'voltage_level': voltage_level,
+            'current_limit': current_limit,
+            'voltage_level_autorange': True,
+            'current_limit_autorange': True,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.ON_DEMAND,
+        })
+        result = measure_dcpower(session, channel_name, dut_setup_time)
 
         session.channels[channel_name].abort()
         # check for error and reset channel
-        session.close()
+        session_pool.release(session)
         return result
 
     except nidcpower.Error:
-        session.output_enabled = False
-        session.reset()
-        session.close()
+        session_pool.discard(session)
         raise
 
 
@@ -166,15 +231,17 @@ def power_on_dut(
 def power_off_dut(
         source_resource_name: str,
         source_channel_name: str,
-        load_resource_name: str,
-        load_channel_name: str
+        load_rails: list[tuple[str, str]]
 ):
-    load_session = nidcpower.Session(resource_name=load_resource_name, channels=load_channel_name)
-    load_session.channels[load_channel_name].output_enabled = False
-    load_session.channels[load_channel_name].reset()
-    load_session.close()
-
-    source_session = nidcpower.Session(resource_name=source_resource_name, channels=source_channel_name)
+    for load_resource_name, load_channel_name in group_rails(load_rails).items():
+        load_session = session_pool.acquire(load_resource_name, load_channel_name)
+        load_session.channels[load_channel_name].output_enabled = False
+        load_session.channels[load_channel_name].reset()
+        session_pool.invalidate(load_session, load_channel_name)
+        session_pool.release(load_session)
+
+    source_session = session_pool.acquire(source_resource_name, source_channel_name)
     source_session.channels[source_channel_name].output_enabled = False
     source_session.channels[source_channel_name].reset()
-    source_session.close()
+    session_pool.invalidate(source_session, source_channel_name)
+    session_pool.release(source_session)
@@ -5,8 +5,12 @@ from enum import Enum
 import ni_measurementlink_service as nims
 from ni_measurementlink_service._internal.stubs.ni.protobuf.types.xydata_pb2 import DoubleXYData
 
+from accuracy_analysis import PERCENTILES, analyze_output_voltage
 from configure_dcpower import *
 from _helpers import *
+from _metrics import MeasurementMetrics, MetricsExporter
+from _result_log import FORMATS, ResultLog
+from _stage_timing import StageTimer, stage, timed_measurement
 
 
 class ModeOfOperation(Enum):
@@ -22,16 +26,8 @@ measurement_service = nims.MeasurementService(
     version="1.0.0.0",
     ui_file_paths=[service_directory / "OutputVoltageAccuracy_PMIC.measui"],
 )
-
-
-def perform_measurement(measurements, total, nominal_output_voltage):
-    output_voltage = total / len(measurements)
-    diff = abs(output_voltage - nominal_output_voltage)
-
-    output_voltage_accuracy = (diff / nominal_output_voltage) * 100
-    output_voltage_accuracy_mv = diff
-
-    return output_voltage, output_voltage_accuracy_mv, output_voltage_accuracy
+metrics = MeasurementMetrics("Output voltage accuracy")
+result_log = ResultLog(measurement_service, "output_voltage_accuracy")
 
 
 @measurement_service.register_measurement
@@ -52,12 +48,35 @@ def perform_measurement(measurements, total, nominal_output_voltage):
 @measurement_service.configuration("Load current level (A)", nims.DataType.Float, 1.0)
 @measurement_service.configuration("Load voltage limit range (V)", nims.DataType.Float, 6.0)
 @measurement_service.configuration("Measurement duration (s)", nims.DataType.Float, 1.0)
+# A comma separated channel list, for example "0,1,2,3", measures several rails in one acquisition. The load resource
+# name can be a list as well, with one resource per channel or per rail
+@measurement_service.configuration("Load channel names", nims.DataType.String, '0')
+# Nominal output voltage of every rail in the order of the load channels, empty uses the nominal output voltage above
+@measurement_service.configuration("Rail nominal output voltages (V)", nims.DataType.DoubleArray1D, [])
+# The time spent in every stage of the run is returned in the timing output, it is always logged with -v
+@measurement_service.configuration("Report timing", nims.DataType.Boolean, False)
 # configure outputs
 @measurement_service.output("Load voltage v/s time", nims.DataType.DoubleXYData)
 @measurement_service.output("Measured output voltage(V)", nims.DataType.Float)
 @measurement_service.output("Output voltage accuracy (V)", nims.DataType.Float)
 @measurement_service.output("Output voltage accuracy (%)", nims.DataType.Float)
 @measurement_service.output("DUT status", nims.DataType.String)
+@measurement_service.output("Standard deviation (V)", nims.DataType.Double)
+@measurement_service.output("Minimum output voltage (V)", nims.DataType.Double)
+@measurement_service.output("Maximum output voltage (V)", nims.DataType.Double)
+@measurement_service.output("Peak-to-peak output voltage (V)", nims.DataType.Double)
+# 1st, 5th, 50th, 95th and 99th percentile of the output voltage record
+@measurement_service.output("Output voltage percentiles (V)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Output voltage drift (V/s)", nims.DataType.Double)
+# per-rail results in the order of the load channels, the single-value outputs above show the first rail
+@measurement_service.output("Measured output voltages (V)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Output voltage accuracies (V)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Output voltage accuracies (%)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Load voltage graphs", nims.DataType.DoubleXYDataArray1D)
+@measurement_service.output("Timing", nims.DataType.String)
+@result_log.instrument
+@metrics.instrument
+@timed_measurement
 def measure(
         mode_of_operation: enumerate,
         dut_setup_time: float,
@@ -69,20 +88,37 @@ def measure(
         load_resource_name: str,
         load_current_level: float,
         load_voltage_limit_range: float,
-        measurement_duration: float
-) -> (DoubleXYData, float, float, float, str):
-    # EDIT SOURCE AND LOAD CHANNEL NAMES HERE FOR USING DIFFERENT CHANNELS
+        measurement_duration: float,
+        load_channel_names: str,
+        rail_nominal_output_voltages: list[float],
+        report_timing: bool
+) -> (DoubleXYData, float, float, float, str, float, float, float, float, list[float], float,
+      list[float], list[float], list[float], list[DoubleXYData], str):
+    # EDIT SOURCE CHANNEL NAME HERE FOR USING A DIFFERENT CHANNEL
     source_device_channel = '0'
-    load_device_channel = '0'
+    timer = StageTimer("Output voltage accuracy")
+    load_rails = parse_load_rails(load_resource_name, load_channel_names)
+    nominal_output_voltages = list(rail_nominal_output_voltages) or [nominal_output_voltage] * len(load_rails)
+    if len(nominal_output_voltages) != len(load_rails):
+        raise ValueError(f"{len(nominal_output_voltages)} rail nominal output voltages do not match "
+                         f"{len(load_rails)} load channels.")
 
     # Initialize results
     load_volt_vs_time = DoubleXYData()
+    # the first rail is drawn on the load voltage graph output
+    load_volt_vs_time_graphs = [load_volt_vs_time] + [DoubleXYData() for _ in load_rails[1:]]
+    output_voltages = [0.0] * len(load_rails)
+    output_voltage_accuracies_mv = [0.0] * len(load_rails)
+    output_voltage_accuracies = [0.0] * len(load_rails)
     output_voltage = output_voltage_accuracy_mv = output_voltage_accuracy = 0
+    standard_deviation = minimum_output_voltage = maximum_output_voltage = pk_to_pk_output_voltage = drift = 0.0
+    percentiles = [0.0] * len(PERCENTILES)
     dut_status = ""
 
     if mode_of_operation == ModeOfOperation.Power_on_dut:
 
-        result = power_on_dut(source_resource_name, source_device_channel, source_voltage_level, source_current_limit)
+        result = power_on_dut(source_resource_name, source_device_channel, source_voltage_level, source_current_limit,
+                              dut_setup_time, aperture_time)
         supply_voltage = result[0]
         supply_current = result[1]
         dut_status = format_dut_info("ON", supply_voltage, supply_current)
@@ -94,36 +130,71 @@ def measure(
         source_session = open_and_configure_dcpower_source(source_resource_name, source_device_channel,
                                                            source_voltage_level, source_current_limit,
                                                            dut_setup_time, aperture_time)
-        source_session.initiate()
-
-        # Configure load
-        load_session = open_and_configure_dcpower_load(load_resource_name, load_device_channel,
-                                                       load_current_level, load_voltage_limit_range,
-                                                       dut_setup_time, aperture_time)
-
-        no_of_samples_to_fetch = int(measurement_duration / aperture_time) + 1
-        # Perform measurement
-        measurements = measure_voltage(load_session, load_device_channel, no_of_samples_to_fetch)
-        length = len(measurements)
-        dt = measurement_duration / length
-        total = 0
-        for i in range(1, length + 1):
-            total += measurements[i - 1]
-            load_volt_vs_time.x_data.append(float(i * dt))
-            load_volt_vs_time.y_data.append(measurements[i - 1])
-
-        output_voltage, output_voltage_accuracy_mv, output_voltage_accuracy = perform_measurement(measurements, total,
-                                                                                                  nominal_output_voltage)
-        close_dcpower(load_session, load_device_channel)
+        load_sessions = {}
+        try:
+            with stage("initiate"):
+                source_session.initiate()
+
+            # Configure load, one session per load instrument with all of its rail channels
+            load_channel_lists = group_rails(load_rails)
+            for load_resource, load_channel_list in load_channel_lists.items():
+                load_sessions[load_resource] = open_and_configure_dcpower_load(load_resource, load_channel_list,
+                                                                               load_current_level,
+                                                                               load_voltage_limit_range,
+                                                                               dut_setup_time, aperture_time)
+
+            no_of_samples_to_fetch = int(measurement_duration / aperture_time) + 1
+            # Perform measurement, the records of all rails are acquired at the same time
+            measurements = measure_voltages(source_session, load_sessions, load_rails, no_of_samples_to_fetch,
+                                            aperture_time, dut_setup_time)
+            with stage("processing"):
+                length = measurements.shape[1]
+                dt = measurement_duration / length
+                if result_log.enabled:
+                    with stage("result log"):
+                        result_log.log_waveforms("records", [f"{resource_name}/{channel_name}"
+                                                             for resource_name, channel_name in load_rails],
+                                                 measurements, dt)
+                time_values = time_axis(dt, dt, length)
+                rail_statistics = []
+                for rail, rail_measurements in enumerate(measurements):
+                    extend_xy_data(load_volt_vs_time_graphs[rail], time_values, rail_measurements)
+                    rail_statistics.append(analyze_output_voltage(rail_measurements, dt, nominal_output_voltages[rail]))
+            output_voltages = [statistics.mean for statistics in rail_statistics]
+            output_voltage_accuracies_mv = [statistics.accuracy for statistics in rail_statistics]
+            output_voltage_accuracies = [statistics.accuracy_percent for statistics in rail_statistics]
+
+            statistics = rail_statistics[0]
+            output_voltage = statistics.mean
+            output_voltage_accuracy_mv = statistics.accuracy
+            output_voltage_accuracy = statistics.accuracy_percent
+            standard_deviation = statistics.standard_deviation
+            minimum_output_voltage = statistics.minimum
+            maximum_output_voltage = statistics.maximum
+            pk_to_pk_output_voltage = statistics.pk_to_pk
+            percentiles = statistics.percentiles
+            drift = statistics.drift
+        except Exception:
+            # the sessions of a failed run are reset and closed, so none of them stays acquired with its output on
+            for load_session in load_sessions.values():
+                session_pool.discard(load_session)
+            session_pool.discard(source_session)
+            raise
+        for load_resource, load_channel_list in load_channel_lists.items():
+            close_dcpower(load_sessions[load_resource], load_channel_list)
         close_dcpower(source_session, source_device_channel)
         dut_status = ""
 
     elif mode_of_operation == ModeOfOperation.Power_off_dut:
-        power_off_dut(source_resource_name, source_device_channel, load_resource_name, load_device_channel)
+        power_off_dut(source_resource_name, source_device_channel, load_rails)
         dut_status = "The DUT is powered OFF"
 
+    timing = timer.finish()
     return (load_volt_vs_time, output_voltage, output_voltage_accuracy_mv,
-            output_voltage_accuracy, dut_status)
+            output_voltage_accuracy, dut_status, standard_deviation, minimum_output_voltage,
+            maximum_output_voltage, pk_to_pk_output_voltage, percentiles, drift, output_voltages,
+            output_voltage_accuracies_mv, output_voltage_accuracies, load_volt_vs_time_graphs,
+            timing if report_timing else "")
 
 
 @click.command
@@ -133,7 +204,47 @@ def measure(
     count=True,
     help="Enable verbose logging. Repeat to increase verbosity.",
 )
-def main(verbose: int) -> None:
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=None,
+    help="Serve measurement metrics at http://127.0.0.1:PORT/metrics.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write measurement metrics to this file periodically.",
+)
+@click.option(
+    "--metrics-interval",
+    type=float,
+    default=10.0,
+    show_default=True,
+    help="Seconds between two writes of the metrics file.",
+)
+@click.option(
+    "--result-log",
+    "result_log_directory",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Log the configuration and results of every measurement run to files in this directory.",
+)
+@click.option(
+    "--result-log-format",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="File format of the result log, Parquet or Arrow IPC stream. Requires the pyarrow package.",
+)
+def main(
+    verbose: int,
+    metrics_port: int,
+    metrics_file: str,
+    metrics_interval: float,
+    result_log_directory: str,
+    result_log_format: str,
+) -> None:
     """Host the output_voltage_accuracy service."""
     if verbose > 1:
         level = logging.DEBUG
@@ -143,8 +254,12 @@ def main(verbose: int) -> None:
         level = logging.WARNING
     logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=level)
 
-    with measurement_service.host_service():
-        input("Press enter to close the measurement service.\n")
+    if result_log_directory:
+        result_log.start(result_log_directory, result_log_format)
+    with result_log, MetricsExporter(metrics, metrics_port, metrics_file, metrics_interval):
+        with measurement_service.host_service():
+            input("Press enter to close the measurement service.\n")
+    session_pool.close_all()
 
 
 if __name__ == "__main__":
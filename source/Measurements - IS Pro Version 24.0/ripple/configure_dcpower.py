@@ -1,20 +1,28 @@
+import threading
+
 import nidcpower
 
+from _session_pool import session_pool
+from _stage_timing import stage
+
 
-# function to reset SMU channel
+# function to reset SMU channel and drop its session from the pool
 def reset_dc_source(session: nidcpower.Session, channel: str):
-    session.channels[channel].output_enabled = False
-    session.channels[channel].reset()
-    session.close()
+    session_pool.discard(session)
     return
 
 
 # function to measure DC levels of SMU
-def measure_dcpower(session: nidcpower.Session, channel_name: str):
+def measure_dcpower(session: nidcpower.Session, channel_name: str, dut_setup_time: float):
     try:
-        with session.channels[channel_name].initiate():
-            session.channels[channel_name].wait_for_event(event_id=nidcpower.Event.SOURCE_COMPLETE, timeout=5)
-            measurements = session.channels[channel_name].measure_multiple()
+        with stage("initiate"):
+            acquisition = session.channels[channel_name].initiate()
+        with acquisition:
+            with stage("DUT setup"):
+                session.channels[channel_name].wait_for_event(event_id=nidcpower.Event.SOURCE_COMPLETE,
+                                                              timeout=dut_setup_time + 5)
+            with stage("measure"):
+                measurements = session.channels[channel_name].measure_multiple()
         measurement = measurements[0]
         result = [measurement.voltage, measurement.current, session]
     except Exception as e:
@@ -23,30 +31,119 @@ def measure_dcpower(session: nidcpower.Session, channel_name: str):
     return result
 
 
+# function to start sourcing and wait until the output has settled, the channel stays initiated for
+# DCPowerMonitor readbacks until close_dcpower aborts it
+def initiate_dcpower(session: nidcpower.Session, channel_name: str, dut_setup_time: float):
+    try:
+        with stage("initiate"):
+            session.channels[channel_name].initiate()
+        with stage("DUT setup"):
+            session.channels[channel_name].wait_for_event(event_id=nidcpower.Event.SOURCE_COMPLETE,
+                                                          timeout=dut_setup_time + 5)
+    except Exception as e:
+        reset_dc_source(session, channel_name)
+        raise e
+    return session
+
+
+class DCPowerMonitor(object):
+    """Reads back the DC levels of initiated SMU channels on a worker thread.
+
+    The readbacks run while the scope is acquiring, so they add no time to the measurement.
+    The worker thread is the only user of the sessions until stop() returns.
+    """
+
+    def __init__(self, channels: list, refresh_interval: float) -> None:
+        """Initialize the monitor.
+
+        Args:
+            channels:
+                (session, channel name) pairs to read back, in the order of the readings.
+            refresh_interval:
+                Time in seconds between readbacks. 0 reads every channel once.
+        """
+        self._channels = channels
+        self._refresh_interval = refresh_interval
+        self._readings = [(0.0, 0.0)] * len(channels)
+        self._lock = threading.Lock()
+        self._first_reading = threading.Event()
+        self._stopping = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="DCPowerMonitor", daemon=True)
+
+    def start(self) -> None:
+        """Start reading back on the worker thread."""
+        self._thread.start()
+
+    def readings(self) -> list:
+        """Return the latest (voltage, current) pair of every channel.
+
+        Waits for the first readback, so the values are never the initial zeros. Raises the
+        exception of a failed readback, if any.
+        """
+        self._first_reading.wait()
+        self._raise_error()
+        with self._lock:
+            return list(self._readings)
+
+    def stop(self) -> None:
+        """Stop the worker thread and wait for the running readback to finish.
+
+        Stopping a monitor that was not started or is already stopped does nothing.
+        """
+        self._stopping.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                readings = []
+                for session, channel_name in self._channels:
+                    measurement = session.channels[channel_name].measure_multiple()[0]
+                    readings.append((measurement.voltage, measurement.current))
+                with self._lock:
+                    self._readings = readings
+                self._first_reading.set()
+                if self._refresh_interval <= 0 or self._stopping.wait(self._refresh_interval):
+                    return
+        except Exception as e:
+            self._error = e
+        finally:
+            self._first_reading.set()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+
 # function to configure power supply SMU
 def power_on_dut(
         resource_name: str,
         channel_name: str,
         source_device_voltage: float,
-        source_current_limit: float
+        source_current_limit: float,
+        dut_setup_time: float,
+        aperture_time: float
 ):
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    session = session_pool.acquire(resource_name, channel_name)
     try:
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_VOLTAGE
-
-        session.channels[channel_name].voltage_level = source_device_voltage
-        session.channels[channel_name].current_limit = source_current_limit
-
-        session.channels[channel_name].voltage_level_autorange = True
-        session.channels[channel_name].current_limit_autorange = True
-
-        session.channels[channel_name].commit()
-        result = measure_dcpower(session, channel_name)
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_VOLTAGE,
+            'voltage_level': source_device_voltage,
+            'current_limit': source_current_limit,
+            'voltage_level_autorange': True,
+            'current_limit_autorange': True,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.ON_DEMAND,
+        })
+        result = measure_dcpower(session, channel_name, dut_setup_time)
 
         session.channels[channel_name].abort()
-        session.close()
+        session_pool.release(session)
     except Exception as e:
         reset_dc_source(session, channel_name)
         raise e
@@ -62,22 +159,21 @@ def open_and_configure_dcpower_source(
         dut_setup_time: float,
         aperture_time: float
 ):
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    session = session_pool.acquire(resource_name, channel_name)
     try:
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_VOLTAGE
-
-        session.channels[channel_name].voltage_level = voltage_level
-        session.channels[channel_name].current_limit = current_limit
-
-        session.channels[channel_name].voltage_level_autorange = True
-        session.channels[channel_name].current_limit_autorange = True
-        session.channels[channel_name].source_delay = dut_setup_time
-        session.channels[channel_name].aperture_time = aperture_time
-        session.channels[channel_name].measure_when = nidcpower.MeasureWhen.ON_DEMAND
-
-        session.channels[channel_name].commit()
+        # only the properties that changed since the previous run are written and committed
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_VOLTAGE,
+            'voltage_level': voltage_level,
+            'current_limit': current_limit,
+            'voltage_level_autorange': True,
+            'current_limit_autorange': True,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.ON_DEMAND,
+        })
     except Exception as e:
         reset_dc_source(session, channel_name)
         raise e
@@ -93,30 +189,30 @@ def open_and_configure_dcpower_load(
         dut_setup_time: float,
         aperture_time: float
 ):
-    session = nidcpower.Session(resource_name=resource_name, channels=channel_name)
+    session = session_pool.acquire(resource_name, channel_name)
     try:
-        session.channels[channel_name].sense = nidcpower.Sense.REMOTE
-        session.channels[channel_name].source_mode = nidcpower.SourceMode.SINGLE_POINT
-        session.channels[channel_name].output_function = nidcpower.OutputFunction.DC_CURRENT
-
-        session.channels[channel_name].current_level = current_level
-        session.channels[channel_name].current_level_autorange = True
-        session.channels[channel_name].voltage_limit_range = voltage_limit_range
-        session.channels[channel_name].source_delay = dut_setup_time
-        session.channels[channel_name].aperture_time = aperture_time
-        session.channels[channel_name].measure_when = nidcpower.MeasureWhen.ON_DEMAND
-
-        session.channels[channel_name].commit()
+        # only the properties that changed since the previous run are written and committed
+        session_pool.configure(session, channel_name, {
+            'sense': nidcpower.Sense.REMOTE,
+            'source_mode': nidcpower.SourceMode.SINGLE_POINT,
+            'output_function': nidcpower.OutputFunction.DC_CURRENT,
+            'current_level': current_level,
+            'current_level_autorange': True,
+            'voltage_limit_range': voltage_limit_range,
+            'source_delay': dut_setup_time,
+            'aperture_time': aperture_time,
+            'measure_when': nidcpower.MeasureWhen.ON_DEMAND,
+        })
     except Exception as e:
         reset_dc_source(session, channel_name)
         raise e
     return session
 
 
-# close dc power session
+# close dc power session, the session itself stays open in the pool for the next run
 def close_dcpower(session, channel_name):
     session.channels[channel_name].abort()
-    session.close()
+    session_pool.release(session)
     return
 
 
@@ -128,13 +224,15 @@ def power_off_dut(
         load_channel_name
 ):
 
-    load_session = nidcpower.Session(resource_name=load_resource_name, channels=load_channel_name)
+    load_session = session_pool.acquire(load_resource_name, load_channel_name)
     load_session.channels[load_channel_name].output_enabled = False
     load_session.channels[load_channel_name].reset()
-    load_session.close()
+    session_pool.invalidate(load_session, load_channel_name)
+    session_pool.release(load_session)
 
-    source_session = nidcpower.Session(resource_name=source_resource_name, channels=source_channel_name)
+    source_session = session_pool.acquire(source_resource_name, source_channel_name)
     source_session.channels[source_channel_name].output_enabled = False
     source_session.channels[source_channel_name].reset()
-    source_session.close()
+    session_pool.invalidate(source_session, source_channel_name)
+    session_pool.release(source_session)
     return
@@ -1,65 +1,147 @@
 import hightime
 import niscope
-from ni_measurementlink_service._internal.stubs.ni.protobuf.types.xydata_pb2 import DoubleXYData
+import numpy as np
 
+from _stage_timing import stage
+from ripple_analysis import DecimatedGraph, RingBuffer
 
-# configure scope device
+
+# function to split a comma separated scope channel list, for example "0,1,2,3", into channel names
+def parse_channel_list(channel_names: str) -> list[str]:
+    channels = [channel.strip() for channel in channel_names.split(",") if channel.strip()]
+    if not channels:
+        raise ValueError("At least one scope channel name is required.")
+    return channels
+
+
+# configure vertical, trigger and horizontal settings of the scope channels
+def configure_scope(
+        session: niscope.Session,
+        channel_names: list[str],
+        sample_rate: float,
+        probe_attenuation: float,
+        record_length: int
+):
+    input_impedance = 1000000  # 1 mega ohm
+    channels = session.channels[",".join(channel_names)]
+
+    channels.configure_vertical(
+        range=2.0,
+        offset=0.0,
+        probe_attenuation=probe_attenuation,
+        coupling=niscope.VerticalCoupling.AC
+    )
+    channels.configure_chan_characteristics(
+        input_impedance=input_impedance,
+        max_input_frequency=-1
+    )
+
+    # all rails are sampled by one acquisition, the first channel triggers it
+    session.trigger_modifier = niscope.TriggerModifier.AUTO
+    session.configure_trigger_edge(
+        trigger_source=channel_names[0],
+        level=0,
+        trigger_coupling=niscope.TriggerCoupling.DC,
+        slope=niscope.TriggerSlope.POSITIVE
+    )
+
+    session.configure_horizontal_timing(
+        min_sample_rate=sample_rate,
+        min_num_pts=record_length,
+        ref_position=0,
+        num_records=1,
+        enforce_realtime=True
+    )
+    return
+
+
+# acquire one record per second on every channel, the scope is re-armed for every record
 def perform_scope_acquisition(
         resource_name: str,
-        channel_name: str,
+        channel_names: list[str],
         sample_rate: float,
         acquisition_time: float,
         probe_attenuation: float,
-        ripple_voltages: list[float],
-        ripple_graph: DoubleXYData
+        ripple_voltages: list[RingBuffer],
+        ripple_graphs: list[DecimatedGraph]
 ):
-    input_impedance = 1000000  # 1 mega ohm
-    t = 0
-
-    with niscope.Session(resource_name) as session:
-        session.channels[channel_name].configure_vertical(
-            range=2.0,
-            offset=0.0,
-            probe_attenuation=probe_attenuation,
-            coupling=niscope.VerticalCoupling.AC
-        )
-        session.channels[channel_name].configure_chan_characteristics(
-            input_impedance=input_impedance,
-            max_input_frequency=-1
-        )
-
-        session.trigger_modifier = niscope.TriggerModifier.AUTO
-        session.configure_trigger_edge(
-            trigger_source=channel_name,
-            level=0,
-            trigger_coupling=niscope.TriggerCoupling.DC,
-            slope=niscope.TriggerSlope.POSITIVE
-        )
-
-        session.configure_horizontal_timing(
-            min_sample_rate=sample_rate,
-            min_num_pts=int(sample_rate),
-            ref_position=0,
-            num_records=1,
-            enforce_realtime=True
-        )
+    with stage("session open"):
+        session = niscope.Session(resource_name)
+    with session:
+        with stage("configure"):
+            configure_scope(session, channel_names, sample_rate, probe_attenuation, int(sample_rate))
+        channels = session.channels[",".join(channel_names)]
 
         while acquisition_time > 0:
-            with session.initiate():
-                waveforms = session.channels[channel_name].fetch(
-                    num_samples=int(sample_rate * (1 if (acquisition_time > 1) else acquisition_time))
-                )
-
-            if waveforms:
-                waveform_info = waveforms[0]
-                ripples = list(waveform_info.samples)
-                ripple_voltages.extend(ripples)
+            with stage("initiate"):
+                acquisition = session.initiate()
+            with acquisition:
+                with stage("fetch"):
+                    waveforms = channels.fetch(
+                        num_samples=int(sample_rate * (1 if (acquisition_time > 1) else acquisition_time))
+                    )
 
+            ripples = np.empty((len(channel_names), 0))
             dt = 1 / session.horz_sample_rate
-            for i in ripples:
-                ripple_graph.x_data.append(t)
-                ripple_graph.y_data.append(i)
-                t += dt
+            if waveforms:
+                with stage("processing"):
+                    # one row of samples per rail, in the order of the channel list
+                    ripples = np.array([waveform_info.samples for waveform_info in waveforms[:len(channel_names)]],
+                                       dtype=np.float64)
+                    dt = waveforms[0].x_increment or dt
+                    for rail, rail_ripples in enumerate(ripples):
+                        ripple_voltages[rail].append(rail_ripples)
+                        ripple_graphs[rail].append(rail_ripples, dt)
 
             acquisition_time -= 1
-            yield ripple_voltages
+            # only the new chunk and its sample interval are yielded, ripple_voltages keeps the retained window
+            yield ripples, dt
+
+
+# acquire one gap-free record on every channel and fetch it in chunks while the acquisition is running
+def perform_continuous_scope_acquisition(
+        resource_name: str,
+        channel_names: list[str],
+        sample_rate: float,
+        acquisition_time: float,
+        probe_attenuation: float,
+        chunk_size: int,
+        ripple_voltages: list[RingBuffer],
+        ripple_graphs: list[DecimatedGraph]
+):
+    total_samples = max(int(sample_rate * acquisition_time), 1)
+    # one second of samples per chunk by default, the same update rate as perform_scope_acquisition
+    chunk_size = min(chunk_size if chunk_size > 0 else max(int(sample_rate), 1), total_samples)
+    # fetch_into reuses this buffer, so a yielded chunk is only valid until the next chunk is fetched.
+    # The driver fills it channel after channel, so each chunk is a view of one row per rail.
+    buffer = np.empty(len(channel_names) * chunk_size, dtype=np.float64)
+    samples_acquired = 0
+
+    with stage("session open"):
+        session = niscope.Session(resource_name)
+    with session:
+        with stage("configure"):
+            configure_scope(session, channel_names, sample_rate, probe_attenuation, total_samples)
+        dt = 1 / session.horz_sample_rate
+        channels = session.channels[",".join(channel_names)]
+
+        with stage("initiate"):
+            acquisition = session.initiate()
+        with acquisition:
+            while samples_acquired < total_samples:
+                num_samples = min(chunk_size, total_samples - samples_acquired)
+                waveform = buffer[:len(channel_names) * num_samples]
+                with stage("fetch"):
+                    channels.fetch_into(
+                        waveform=waveform,
+                        relative_to=niscope.FetchRelativeTo.READ_POINTER,
+                        offset=0,
+                        timeout=hightime.timedelta(seconds=num_samples * dt + 5.0)
+                    )
+                with stage("processing"):
+                    ripples = waveform.reshape(len(channel_names), num_samples)
+                    for rail, rail_ripples in enumerate(ripples):
+                        ripple_voltages[rail].append(rail_ripples)
+                        ripple_graphs[rail].append(rail_ripples, dt)
+                samples_acquired += num_samples
+                yield ripples, dt
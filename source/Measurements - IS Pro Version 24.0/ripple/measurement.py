@@ -2,11 +2,16 @@ import sys
 from enum import Enum
 
 import ni_measurementlink_service as nims
+import numpy as np
 from _helpers import *
+from _metrics import MeasurementMetrics, MetricsExporter
+from _result_log import FORMATS, ResultLog
+from _stage_timing import StageTimer, stage, timed_measurement
 
 from configure_dcpower import *
 from configure_niscope_acquisition import *
-import numpy as np
+from ripple_analysis import DecimatedGraph, RingBuffer, RippleStatistics, WelchSpectrum
+from waveform_archive import WaveformArchive
 
 
 class ModeOfOperation(Enum):
@@ -16,14 +21,6 @@ class ModeOfOperation(Enum):
     pass
 
 
-def calculate_pk_to_pk(signal):
-    return np.max(signal) - np.min(signal)
-
-
-def calculate_rms(signal):
-    return np.sqrt(np.mean(np.square(signal)))
-
-
 def format_dut_info(status, voltage, current):
     return "The DUT is powered %s\nVoltage Level: %.3f V\nCurrent Limit: %.3f A" % (status, voltage, current)
 
@@ -35,6 +32,8 @@ measurement_service = nims.MeasurementService(
     version="0.1.0.0",
     ui_file_paths=[service_directory / "Ripple_PMIC.measui"],
 )
+metrics = MeasurementMetrics("Ripple")
+result_log = ResultLog(measurement_service, "ripple")
 
 
 @measurement_service.register_measurement
@@ -50,10 +49,32 @@ measurement_service = nims.MeasurementService(
 @measurement_service.configuration("Load current level (A)", nims.DataType.Float, 1.0)
 @measurement_service.configuration("Load voltage limit range (V)", nims.DataType.Float, 6.0)
 @measurement_service.configuration("Scope resource name", nims.DataType.String, 'Scope')
+# A comma separated channel list, for example "0,1,2,3", measures the ripple of several rails in one acquisition
 @measurement_service.configuration("Scope channel name", nims.DataType.String, '0')
 @measurement_service.configuration("Sample rate (Hz)", nims.DataType.Double, 10000.0)
 @measurement_service.configuration("Acquisition time (s)", nims.DataType.Double, 3.0)
 @measurement_service.configuration("Probe attenuation", nims.DataType.Float, 1.0)
+# Continuous acquisition captures one gap-free record instead of re-arming the scope every second
+@measurement_service.configuration("Continuous acquisition", nims.DataType.Boolean, False)
+# Samples fetched per chunk in continuous acquisition, 0 fetches one second of samples per chunk
+@measurement_service.configuration("Chunk size (samples)", nims.DataType.Int32, 0)
+# The ripple graph shows a min/max envelope of at most this many points, 0 shows every sample
+@measurement_service.configuration("Ripple graph maximum points", nims.DataType.Int32, 10000)
+# Samples per FFT segment of the averaged ripple spectrum, 0 disables the spectral analysis
+@measurement_service.configuration("FFT segment length (samples)", nims.DataType.Int32, 4096)
+# Only the most recent samples of this time window are kept in memory and shown on the ripple graph,
+# 0 keeps the whole acquisition
+@measurement_service.configuration("Retained window (s)", nims.DataType.Double, 10.0)
+# The source and load levels are read back every interval while the scope acquires, 0 reads them once
+@measurement_service.configuration("DC readback interval (s)", nims.DataType.Double, 1.0)
+# Incremental updates send only the ripple graph points added since the previous update, the final result is complete
+@measurement_service.configuration("Incremental updates", nims.DataType.Boolean, False)
+# Intermediate results are sent at most once per interval, 0 sends every update
+@measurement_service.configuration("Minimum update interval (s)", nims.DataType.Double, 0.0)
+# The time spent in every stage of the run is returned in the timing output, it is always logged with -v
+@measurement_service.configuration("Report timing", nims.DataType.Boolean, False)
+# The raw scope samples are streamed into a memory-mapped .npy file in this directory, empty disables the archive
+@measurement_service.configuration("Archive directory", nims.DataType.Path, '')
 # configure outputs
 @measurement_service.output("Source voltage (V)", nims.DataType.Float)
 @measurement_service.output("Source current (A)", nims.DataType.Float)
@@ -63,6 +84,19 @@ measurement_service = nims.MeasurementService(
 @measurement_service.output("Ripple P-P voltage (V)", nims.DataType.Float)
 @measurement_service.output("Ripple graph", nims.DataType.DoubleXYData)
 @measurement_service.output("DUT status", nims.DataType.String)
+@measurement_service.output("Ripple spectrum", nims.DataType.DoubleXYData)
+@measurement_service.output("Dominant frequency (Hz)", nims.DataType.Double)
+@measurement_service.output("Dominant amplitude (V)", nims.DataType.Double)
+@measurement_service.output("Noise floor (V)", nims.DataType.Double)
+# per-rail results in the order of the scope channel list, the scalar ripple outputs above show the first rail
+@measurement_service.output("Ripple RMS voltages (V)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Ripple P-P voltages (V)", nims.DataType.DoubleArray1D)
+@measurement_service.output("Ripple graphs", nims.DataType.DoubleXYDataArray1D)
+@measurement_service.output("Timing", nims.DataType.String)
+@measurement_service.output("Archive file", nims.DataType.Path)
+@result_log.instrument
+@metrics.instrument
+@timed_measurement
 def measure(
         mode_of_operation: enumerate,
         dut_setup_time: float,
@@ -78,18 +112,51 @@ def measure(
         scope_sample_rate: float,
         scope_acquisition_time: float,
         scope_probe_attenuation: float,
-) -> (float, float, float, float, float, float, DoubleXYData, str):
+        scope_continuous_acquisition: bool,
+        scope_chunk_size: int,
+        ripple_graph_maximum_points: int,
+        fft_segment_length: int,
+        retained_window: float,
+        dc_readback_interval: float,
+        incremental_updates: bool,
+        minimum_update_interval: float,
+        report_timing: bool,
+        archive_directory: str,
+) -> (float, float, float, float, float, float, DoubleXYData, str, DoubleXYData, float, float, float,
+       list[float], list[float], list[DoubleXYData], str, str):
     # EDIT SOURCE AND LOAD CHANNEL NAMES HERE FOR USING DIFFERENT CHANNELS
     source_device_channel = '0'
     load_device_channel = '0'
 
-    ripple_voltages = []
+    timer = StageTimer("Ripple")
+    timing = ''
+
+    total_samples = int(scope_sample_rate * scope_acquisition_time)
+    window_samples = min(total_samples, int(scope_sample_rate * retained_window)) if retained_window > 0 else total_samples
+    scope_channel_names = parse_channel_list(scope_channel_name)
+    # float32 halves the memory of the retained samples, the scope resolution does not need more
+    ripple_voltages = [RingBuffer(window_samples, np.float32) for _ in scope_channel_names]
+    ripple_statistics = [RippleStatistics() for _ in scope_channel_names]
+    ripple_voltages_rms = [0.0] * len(scope_channel_names)
+    ripple_voltages_pk_to_pk = [0.0] * len(scope_channel_names)
+    ripple_spectrum = WelchSpectrum(fft_segment_length)
+    spectrum_graph = DoubleXYData()
+    dominant_frequency = dominant_amplitude = noise_floor = 0.0
     supply_voltage = supply_current = load_voltage = load_current = ripple_voltage_rms = ripple_voltage_pk_to_pk = 0
     ripple_graph = DoubleXYData()
+    # the first rail is drawn on the ripple graph output
+    ripple_graphs = [ripple_graph] + [DoubleXYData() for _ in scope_channel_names[1:]]
+    ripple_graph_envelopes = [DecimatedGraph(graph, ripple_graph_maximum_points, window_samples)
+                              for graph in ripple_graphs]
     dut_status = ''
+    archive = None
+    archive_file = ''
+    update_throttle = UpdateThrottle(minimum_update_interval)
+    ripple_graph_deltas = [OutputDelta() for _ in ripple_graphs]
 
     if mode_of_operation == ModeOfOperation.power_on_dut:
-        result = power_on_dut(source_resource_name, source_device_channel, source_voltage_level, source_current_limit)
+        result = power_on_dut(source_resource_name, source_device_channel, source_voltage_level, source_current_limit,
+                              dut_setup_time, aperture_time)
         supply_voltage = result[0]
         supply_current = result[1]
         dut_status = format_dut_info("ON", supply_voltage, supply_current)
@@ -97,45 +164,115 @@ def measure(
 
     elif mode_of_operation == ModeOfOperation.perform_measurement:
 
+        # the DUT is powered and loaded before the capture, the DC readbacks then run during the capture
         dcpower_source_session = open_and_configure_dcpower_source(source_resource_name, source_device_channel,
                                                                    source_voltage_level, source_current_limit,
                                                                    dut_setup_time, aperture_time)
-        result = measure_dcpower(dcpower_source_session, source_device_channel)
-        supply_voltage = result[0]
-        supply_current = result[1]
-        dcpower_source_session = result[2]
-        result.clear()
+        initiate_dcpower(dcpower_source_session, source_device_channel, dut_setup_time)
 
         dcpower_load_session = open_and_configure_dcpower_load(load_resource_name, load_device_channel,
                                                                load_current_level, load_voltage_limit_range,
                                                                dut_setup_time, aperture_time)
-        result = measure_dcpower(dcpower_load_session, load_device_channel)
-        load_voltage = result[0]
-        load_current = result[1]
-        dcpower_load_session = result[2]
+        initiate_dcpower(dcpower_load_session, load_device_channel, dut_setup_time)
+
+        dcpower_monitor = DCPowerMonitor([(dcpower_source_session, source_device_channel),
+                                          (dcpower_load_session, load_device_channel)],
+                                         dc_readback_interval)
 
+        ripple_generator = None
         # code to reset DC sources if error occurs at scope device
         try:
-            ripple_generator = perform_scope_acquisition(
-                scope_resource_name,
-                scope_channel_name,
-                scope_sample_rate,
-                scope_acquisition_time,
-                scope_probe_attenuation,
-                ripple_voltages,
-                ripple_graph
-            )
-
-            for ripples in ripple_generator:
-                ripple_graph_array = np.array(ripples, dtype=np.float64)
-                ripple_voltage_rms = calculate_rms(ripple_graph_array)
-                ripple_voltage_pk_to_pk = calculate_pk_to_pk(ripple_graph_array)
-                yield (supply_voltage, supply_current, load_voltage, load_current,
-                       ripple_voltage_rms, ripple_voltage_pk_to_pk, ripple_graph, dut_status)
+            dcpower_monitor.start()
+            if archive_directory:
+                with stage("archive"):
+                    archive = WaveformArchive(archive_directory, scope_resource_name, scope_channel_names,
+                                              total_samples, scope_sample_rate, scope_probe_attenuation,
+                                              scope_continuous_acquisition)
+                archive_file = str(archive.path)
+            if scope_continuous_acquisition:
+                ripple_generator = perform_continuous_scope_acquisition(
+                    scope_resource_name,
+                    scope_channel_names,
+                    scope_sample_rate,
+                    scope_acquisition_time,
+                    scope_probe_attenuation,
+                    scope_chunk_size,
+                    ripple_voltages,
+                    ripple_graph_envelopes
+                )
+            else:
+                ripple_generator = perform_scope_acquisition(
+                    scope_resource_name,
+                    scope_channel_names,
+                    scope_sample_rate,
+                    scope_acquisition_time,
+                    scope_probe_attenuation,
+                    ripple_voltages,
+                    ripple_graph_envelopes
+                )
+
+            for ripples, dt in ripple_generator:
+                if archive is not None:
+                    # the chunk is only valid until the next fetch, so it is archived before anything else
+                    with stage("archive"):
+                        archive.append(ripples, dt)
+                if result_log.enabled:
+                    with stage("result log"):
+                        result_log.log_waveforms("chunks", scope_channel_names, ripples, dt)
+                with stage("processing"):
+                    for rail, rail_ripples in enumerate(ripples):
+                        ripple_statistics[rail].update(rail_ripples)
+                        ripple_voltages_rms[rail] = ripple_statistics[rail].rms
+                        ripple_voltages_pk_to_pk[rail] = ripple_statistics[rail].pk_to_pk
+                    ripple_voltage_rms = ripple_voltages_rms[0]
+                    ripple_voltage_pk_to_pk = ripple_voltages_pk_to_pk[0]
+                    # the spectrum is analysed on the first rail
+                    if ripple_spectrum.update(ripples[0], dt):
+                        ripple_spectrum.to_xy_data(spectrum_graph)
+                        dominant_frequency, dominant_amplitude = ripple_spectrum.dominant_tone()
+                        noise_floor = ripple_spectrum.noise_floor()
+                if not update_throttle.due():
+                    continue
+                with stage("DC readback"):
+                    (supply_voltage, supply_current), (load_voltage, load_current) = dcpower_monitor.readings()
+                updated_ripple_graphs = ripple_graphs
+                if incremental_updates:
+                    updated_ripple_graphs = [
+                        ripple_graph_delta(graph, envelope.points_added)
+                        for ripple_graph_delta, graph, envelope
+                        in zip(ripple_graph_deltas, ripple_graphs, ripple_graph_envelopes)
+                    ]
+                if report_timing:
+                    timing = timer.summary()
+                with stage("yield"):
+                    yield (supply_voltage, supply_current, load_voltage, load_current,
+                           ripple_voltage_rms, ripple_voltage_pk_to_pk, updated_ripple_graphs[0], dut_status,
+                           spectrum_graph, dominant_frequency, dominant_amplitude, noise_floor,
+                           ripple_voltages_rms, ripple_voltages_pk_to_pk, updated_ripple_graphs, timing, archive_file)
+            with stage("processing"):
+                for ripple_graph_envelope in ripple_graph_envelopes:
+                    ripple_graph_envelope.flush()
+            with stage("DC readback"):
+                dcpower_monitor.stop()
+                (supply_voltage, supply_current), (load_voltage, load_current) = dcpower_monitor.readings()
         except Exception as e:
+            dcpower_monitor.stop()
             reset_dc_source(dcpower_source_session, source_device_channel)
             reset_dc_source(dcpower_load_session, load_device_channel)
             raise e
+        except GeneratorExit:
+            # the client canceled the measurement, the sessions go back to the pool so the next run can use them
+            dcpower_monitor.stop()
+            close_dcpower(dcpower_load_session, load_device_channel)
+            close_dcpower(dcpower_source_session, source_device_channel)
+            raise
+        finally:
+            # also stops the readbacks, the scope acquisition and the archive when the client cancels the measurement
+            dcpower_monitor.stop()
+            if ripple_generator is not None:
+                ripple_generator.close()
+            if archive is not None:
+                archive.close()
 
         close_dcpower(dcpower_load_session, load_device_channel)
         close_dcpower(dcpower_source_session, source_device_channel)
@@ -145,8 +282,11 @@ def measure(
         power_off_dut(source_resource_name, source_device_channel, load_resource_name, load_device_channel)
         dut_status = "The DUT is powered OFF"
 
+    timing = timer.finish()
     return (supply_voltage, supply_current, load_voltage, load_current,
-            ripple_voltage_rms, ripple_voltage_pk_to_pk, ripple_graph, dut_status)
+            ripple_voltage_rms, ripple_voltage_pk_to_pk, ripple_graph, dut_status,
+            spectrum_graph, dominant_frequency, dominant_amplitude, noise_floor,
+            ripple_voltages_rms, ripple_voltages_pk_to_pk, ripple_graphs, timing if report_timing else '', archive_file)
 
 
 @click.command
@@ -156,7 +296,47 @@ def measure(
     count=True,
     help="Enable verbose logging. Repeat to increase verbosity.",
 )
-def main(verbose: int) -> None:
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=None,
+    help="Serve measurement metrics at http://127.0.0.1:PORT/metrics.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write measurement metrics to this file periodically.",
+)
+@click.option(
+    "--metrics-interval",
+    type=float,
+    default=10.0,
+    show_default=True,
+    help="Seconds between two writes of the metrics file.",
+)
+@click.option(
+    "--result-log",
+    "result_log_directory",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Log the configuration and results of every measurement run to files in this directory.",
+)
+@click.option(
+    "--result-log-format",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="File format of the result log, Parquet or Arrow IPC stream. Requires the pyarrow package.",
+)
+def main(
+    verbose: int,
+    metrics_port: int,
+    metrics_file: str,
+    metrics_interval: float,
+    result_log_directory: str,
+    result_log_format: str,
+) -> None:
     """Host the ripple service."""
     if verbose > 1:
         level = logging.DEBUG
@@ -166,8 +346,12 @@ def main(verbose: int) -> None:
         level = logging.WARNING
     logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=level)
 
-    with measurement_service.host_service():
-        input("Press enter to close the measurement service.\n")
+    if result_log_directory:
+        result_log.start(result_log_directory, result_log_format)
+    with result_log, MetricsExporter(metrics, metrics_port, metrics_file, metrics_interval):
+        with measurement_service.host_service():
+            input("Press enter to close the measurement service.\n")
+    session_pool.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,274 @@
+"""Streaming analysis of ripple waveforms that are acquired in chunks."""
+
+import math
+
+import numpy as np
+from ni_measurementlink_service._internal.stubs.ni.protobuf.types.xydata_pb2 import DoubleXYData
+
+from _helpers import extend_xy_data, time_axis
+
+
+class RippleStatistics(object):
+    """Running RMS and peak-to-peak value of a ripple waveform.
+
+    Only the sum of squares, minimum, maximum and sample count are kept, so the cost of an
+    update depends on the size of the new chunk and not on the total acquisition length.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum_of_squares = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def update(self, samples) -> None:
+        """Add a chunk of samples to the statistics."""
+        chunk = np.asarray(samples, dtype=np.float64)
+        if chunk.size == 0:
+            return
+        self.count += chunk.size
+        self.sum_of_squares += float(np.dot(chunk, chunk))
+        self.minimum = min(self.minimum, float(chunk.min()))
+        self.maximum = max(self.maximum, float(chunk.max()))
+
+    @property
+    def rms(self) -> float:
+        """RMS value of all samples added so far."""
+        return math.sqrt(self.sum_of_squares / self.count) if self.count else 0.0
+
+    @property
+    def pk_to_pk(self) -> float:
+        """Peak-to-peak value of all samples added so far."""
+        return self.maximum - self.minimum if self.count else 0.0
+
+
+def min_max_envelope(x_data: np.ndarray, y_data: np.ndarray, bucket_size: int) -> tuple:
+    """Reduce each bucket of samples to its minimum and maximum, in time order.
+
+    Peaks survive the decimation, so the peak-to-peak value visible on the graph stays correct.
+    A trailing partial bucket is reduced the same way.
+
+    Returns:
+        The x and y values of the envelope.
+    """
+    if bucket_size <= 2 or y_data.size <= 2:
+        return x_data, y_data
+    full_size = y_data.size - y_data.size % bucket_size
+    buckets = y_data[:full_size].reshape(-1, bucket_size)
+    offsets = np.arange(0, full_size, bucket_size)
+    first = offsets + np.minimum(buckets.argmin(axis=1), buckets.argmax(axis=1))
+    last = offsets + np.maximum(buckets.argmin(axis=1), buckets.argmax(axis=1))
+    indices = np.column_stack((first, last)).ravel()
+    if full_size < y_data.size:
+        tail = y_data[full_size:]
+        tail_indices = full_size + np.unique([tail.argmin(), tail.argmax()])
+        indices = np.concatenate((indices, tail_indices))
+    return x_data[indices], y_data[indices]
+
+
+class RingBuffer(object):
+    """Preallocated NumPy buffer that keeps the most recent samples of a stream.
+
+    Appending never allocates: once the buffer is full, new samples overwrite the oldest ones.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float64) -> None:
+        """Initialize the buffer.
+
+        Args:
+            capacity: Maximum number of samples kept.
+            dtype: NumPy data type of the stored samples, for example np.float64 or np.float32.
+        """
+        self._data = np.empty(max(capacity, 0), dtype=dtype)
+        self._start = 0
+        self.size = 0
+        self.total_appended = 0
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of samples kept."""
+        return self._data.size
+
+    def append(self, samples) -> None:
+        """Append samples, dropping the oldest samples when the buffer is full."""
+        values = np.asarray(samples, dtype=self._data.dtype).ravel()
+        self.total_appended += values.size
+        capacity = self.capacity
+        if capacity == 0 or values.size == 0:
+            return
+        if values.size >= capacity:
+            self._data[:] = values[-capacity:]
+            self._start = 0
+            self.size = capacity
+            return
+        end = (self._start + self.size) % capacity
+        first = min(values.size, capacity - end)
+        self._data[end:end + first] = values[:first]
+        self._data[:values.size - first] = values[first:]
+        dropped = self.size + values.size - capacity
+        if dropped > 0:
+            self._start = (self._start + dropped) % capacity
+            self.size = capacity
+        else:
+            self.size += values.size
+
+    def values(self) -> np.ndarray:
+        """Return a copy of the kept samples, oldest first."""
+        end = self._start + self.size
+        if end <= self.capacity:
+            return self._data[self._start:end].copy()
+        return np.concatenate((self._data[self._start:], self._data[:end - self.capacity]))
+
+
+class DecimatedGraph(object):
+    """Ripple graph that receives full-rate chunks and shows a min/max envelope of a time window.
+
+    The bucket size is fixed from the number of samples in the window, so the graph never holds
+    more than max_points points. The envelope points are kept in ring buffers; when the
+    acquisition is longer than the window, the oldest points are dropped. Samples of an
+    incomplete bucket are held back until the bucket is complete or flush() is called.
+    """
+
+    def __init__(self, xy_data: DoubleXYData, max_points: int, window_samples: int) -> None:
+        """Initialize the graph.
+
+        Args:
+            xy_data:
+                The DoubleXYData output that receives the envelope.
+            max_points:
+                Maximum number of points on the graph. 0 disables the decimation.
+            window_samples:
+                Number of most recent samples the graph shows.
+        """
+        self.xy_data = xy_data
+        # an empty window still gets buckets of one sample, a bucket size of 0 cannot split the chunks
+        self.bucket_size = max(math.ceil(window_samples / (max_points // 2)), 1) if max_points >= 2 else 1
+        self.samples_appended = 0
+        # min_max_envelope() keeps both samples of a bucket of two
+        points_per_bucket = min(self.bucket_size, 2)
+        capacity = math.ceil(window_samples / self.bucket_size) * points_per_bucket
+        self._x_data = RingBuffer(capacity)
+        self._y_data = RingBuffer(capacity)
+        self._pending_x = np.empty(0)
+        self._pending_y = np.empty(0)
+
+    @property
+    def points_added(self) -> int:
+        """Number of points added to the graph so far, including the points that were dropped from the window."""
+        return self._y_data.total_appended
+
+    def append(self, samples, dt: float) -> None:
+        """Add the next chunk of a uniformly sampled waveform with sample interval dt."""
+        y_data = np.asarray(samples, dtype=np.float64)
+        x_data = time_axis(self.samples_appended * dt, dt, y_data.size)
+        self.samples_appended += y_data.size
+        if self._pending_y.size:
+            x_data = np.concatenate((self._pending_x, x_data))
+            y_data = np.concatenate((self._pending_y, y_data))
+        full_size = y_data.size - y_data.size % self.bucket_size
+        self._add_points(*min_max_envelope(x_data[:full_size], y_data[:full_size], self.bucket_size))
+        self._pending_x = x_data[full_size:].copy()
+        self._pending_y = y_data[full_size:].copy()
+
+    def flush(self) -> None:
+        """Add the envelope of the samples of the last, incomplete bucket to the graph."""
+        if self._pending_y.size:
+            self._add_points(*min_max_envelope(self._pending_x, self._pending_y, self.bucket_size))
+            self._pending_x = np.empty(0)
+            self._pending_y = np.empty(0)
+
+    def _add_points(self, x_data: np.ndarray, y_data: np.ndarray) -> None:
+        self._x_data.append(x_data)
+        self._y_data.append(y_data)
+        del self.xy_data.x_data[:]
+        del self.xy_data.y_data[:]
+        extend_xy_data(self.xy_data, self._x_data.values(), self._y_data.values())
+
+
+class WelchSpectrum(object):
+    """Averaged amplitude spectrum of a ripple waveform that is acquired in chunks.
+
+    Welch's method: the waveform is cut into Hann-windowed segments with 50 % overlap, the FFTs
+    of all segments of a chunk are computed in one vectorized call and their power is added to a
+    running sum. Samples that do not fill a segment yet are carried over to the next chunk, so
+    the cost of an update depends only on the chunk size.
+    """
+
+    def __init__(self, segment_length: int) -> None:
+        """Initialize the spectrum.
+
+        Args:
+            segment_length: Number of samples per FFT segment. 0 disables the analysis.
+        """
+        self.segment_length = max(segment_length, 0)
+        self.segments = 0
+        self.dt = 0.0
+        self._window = np.hanning(self.segment_length)
+        self._hop = max(self.segment_length // 2, 1)
+        self._power_sum = np.zeros(self.segment_length // 2 + 1)
+        self._pending = np.empty(0)
+
+    def update(self, samples, dt: float) -> bool:
+        """Add a chunk of samples with sample interval dt.
+
+        Returns:
+            True if the chunk completed at least one new segment.
+        """
+        if self.segment_length < 2:
+            return False
+        self.dt = dt
+        data = np.concatenate((self._pending, np.asarray(samples, dtype=np.float64)))
+        if data.size < self.segment_length:
+            self._pending = data
+            return False
+        segments = np.lib.stride_tricks.sliding_window_view(data, self.segment_length)[::self._hop]
+        spectra = np.fft.rfft(segments * self._window, axis=1)
+        self._power_sum += np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=0)
+        self.segments += segments.shape[0]
+        self._pending = data[segments.shape[0] * self._hop:].copy()
+        return True
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        """Frequency of each spectrum bin in Hz."""
+        if not self.segments:
+            return np.empty(0)
+        return np.fft.rfftfreq(self.segment_length, self.dt)
+
+    @property
+    def amplitudes(self) -> np.ndarray:
+        """Peak amplitude in V of a tone at the frequency of each spectrum bin."""
+        if not self.segments:
+            return np.empty(0)
+        return np.sqrt(self._power_sum / self.segments) * 2 / self._window.sum()
+
+    def dominant_tone(self) -> tuple:
+        """Return the frequency in Hz and peak amplitude in V of the strongest tone.
+
+        The DC bin and the bin next to it, which holds the window leakage of DC, are skipped.
+        Frequency and amplitude are refined by a parabolic fit through the log amplitudes of the
+        peak bin and its neighbours, which removes most of the scalloping loss of the window.
+        """
+        amplitudes = self.amplitudes
+        if amplitudes.size < 4:
+            return 0.0, 0.0
+        peak = 2 + int(np.argmax(amplitudes[2:]))
+        offset = 0.0
+        log_amplitude = np.log(max(amplitudes[peak], np.finfo(float).tiny))
+        if peak + 1 < amplitudes.size:
+            left, center, right = np.log(np.maximum(amplitudes[peak - 1:peak + 2], np.finfo(float).tiny))
+            denominator = left - 2 * center + right
+            offset = 0.5 * (left - right) / denominator if denominator else 0.0
+            log_amplitude = center - 0.25 * (left - right) * offset
+        return float((peak + offset) / (self.segment_length * self.dt)), float(np.exp(log_amplitude))
+
+    def noise_floor(self) -> float:
+        """Median peak amplitude in V of all bins except DC."""
+        amplitudes = self.amplitudes
+        return float(np.median(amplitudes[1:])) if amplitudes.size > 1 else 0.0
+
+    def to_xy_data(self, xy_data: DoubleXYData) -> None:
+        """Replace the content of a DoubleXYData with the amplitude spectrum."""
+        del xy_data.x_data[:]
+        del xy_data.y_data[:]
+        extend_xy_data(xy_data, self.frequencies, self.amplitudes)
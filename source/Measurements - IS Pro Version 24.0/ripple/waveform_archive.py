@@ -0,0 +1,95 @@
+"""Archival of the raw scope samples of ripple acquisitions in memory-mapped .npy files."""
+
+import datetime
+import json
+import pathlib
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class WaveformArchive(object):
+    """Preallocated (rails x samples) .npy file that the fetched chunks are written into.
+
+    The file is created with its final size and mapped into memory, so a chunk is copied once,
+    from the fetch buffer to the page cache, and the operating system writes it to disk. Each rail
+    is one contiguous row. A JSON sidecar with the same name stores the sample rate and interval,
+    the probe attenuation, the channels and the number of samples that were written.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            resource_name: str,
+            channel_names: list[str],
+            total_samples: int,
+            sample_rate: float,
+            probe_attenuation: float,
+            continuous: bool
+    ) -> None:
+        """Create the archive files.
+
+        Args:
+            directory: Directory of the archive, it is created if it does not exist.
+            resource_name: Resource name of the scope.
+            channel_names: Scope channels, one row of samples per channel.
+            total_samples: Number of samples per channel that are preallocated.
+            sample_rate: The requested sample rate in Hz, replaced by the actual rate of the first chunk.
+            probe_attenuation: Probe attenuation of the scope channels.
+            continuous: Whether the samples are one gap-free record or one record per second.
+        """
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        self.path = directory / f"ripple-{started.strftime('%Y%m%d-%H%M%S-%f')}.npy"
+        self.metadata_path = self.path.with_suffix(".json")
+        self.samples = np.lib.format.open_memmap(
+            self.path, mode="w+", dtype=np.float64, shape=(len(channel_names), max(total_samples, 0))
+        )
+        self.count = 0
+        self.metadata = {
+            "resource_name": resource_name,
+            "channel_names": channel_names,
+            "sample_rate": sample_rate,
+            "x_increment": 1 / sample_rate,
+            "probe_attenuation": probe_attenuation,
+            "continuous": continuous,
+            "start_time": started.isoformat(),
+            "samples": 0,
+        }
+        self._write_metadata()
+
+    def append(self, ripples: np.ndarray, dt: float) -> None:
+        """Write the next (rails x samples) chunk, samples beyond the preallocated size are dropped."""
+        if self.count == 0:
+            self.metadata["sample_rate"] = 1 / dt
+            self.metadata["x_increment"] = dt
+        num_samples = min(ripples.shape[1], self.samples.shape[1] - self.count)
+        self.samples[:, self.count:self.count + num_samples] = ripples[:, :num_samples]
+        self.count += num_samples
+
+    def close(self) -> None:
+        """Flush the samples to disk and record the number of samples in the sidecar."""
+        if self.samples is None:
+            return
+        self.samples.flush()
+        self.samples = None
+        self.metadata["samples"] = self.count
+        self._write_metadata()
+
+    def _write_metadata(self) -> None:
+        with open(self.metadata_path, "w", encoding="utf-8") as file:
+            json.dump(self.metadata, file, indent=2)
+
+
+def open_waveform_archive(path: str, metadata_path: Optional[str] = None) -> Tuple[np.ndarray, dict]:
+    """Map the samples of a waveform archive read-only, only the pages that are accessed are read.
+
+    Returns:
+        A (rails x samples) view of the samples that were written and the sidecar metadata.
+    """
+    path = pathlib.Path(path)
+    with open(metadata_path or path.with_suffix(".json"), encoding="utf-8") as file:
+        metadata = json.load(file)
+    samples = np.load(path, mmap_mode="r")
+    return samples[:, :metadata["samples"]], metadata
@@ -0,0 +1,422 @@
+"""In-process fake NI-DCPower and NI-SCOPE sessions for benchmarking the measurement services.
+
+The fakes implement the part of the nidcpower.Session and niscope.Session surface that the
+measurement services use (channels[...], property writes, commit/initiate/abort, measure_multiple,
+fetch_multiple, _fetch_multiple, fetch and fetch_into). They return synthetic but plausible data
+instantly, unless a time scale is set, in which case acquisitions take aperture time x time scale
+to complete.
+"""
+
+import array
+import collections
+import math
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import nidcpower
+import niscope
+import numpy as np
+
+Measurement = collections.namedtuple("Measurement", ["voltage", "current", "in_compliance", "channel"])
+
+# Output voltage reported by the fake DUT that sits between the source and the load.
+DUT_OUTPUT_VOLTAGE = 3.3
+# Current drawn from the source by the fake DUT.
+DUT_INPUT_CURRENT = 0.4
+
+
+class CountingProxy(object):
+    """Wraps a session and counts every method call, property read and property write."""
+
+    def __init__(self, target: Any, counts: collections.Counter) -> None:
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_counts", counts)
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(self._target, name)
+        if name == "channels":
+            return _CountingChannels(value, self._counts)
+        if callable(value):
+            def _counted(*args, **kwargs):
+                self._counts[name] += 1
+                return value(*args, **kwargs)
+            return _counted
+        self._counts[f"{name} (get)"] += 1
+        return value
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        self._counts[f"{name} (set)"] += 1
+        setattr(self._target, name, value)
+
+    def __enter__(self) -> "CountingProxy":
+        self._target.__enter__()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._counts["close"] += 1
+        self._target.__exit__(*exc_info)
+
+
+class _CountingChannels(object):
+    def __init__(self, target: Any, counts: collections.Counter) -> None:
+        self._target = target
+        self._counts = counts
+
+    def __getitem__(self, key: str) -> CountingProxy:
+        self._counts["channels[]"] += 1
+        return CountingProxy(self._target[key], self._counts)
+
+
+class _Initiated(object):
+    """Return value of initiate(); aborts the session when used as a context manager."""
+
+    def __init__(self, session: Any) -> None:
+        self._session = session
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        self._session.abort()
+
+
+class _Channels(object):
+    def __init__(self, session: Any) -> None:
+        self._session = session
+
+    def __getitem__(self, key: str) -> Any:
+        return self._session._channel_view(key)
+
+
+class FakeDCPowerSession(object):
+    """Stand-in for nidcpower.Session.
+
+    In DC voltage mode the channel reports the programmed voltage and the current drawn by
+    the DUT; in DC current mode it reports the DUT output voltage and the programmed current.
+    All channels of a multi-channel session share their configuration, only the fetch position
+    is kept per channel.
+    """
+
+    def __init__(self, resource_name: str, channels: Optional[str] = None, time_scale: float = 0.0,
+                 **kwargs) -> None:
+        self.__dict__.update(
+            resource_name=resource_name,
+            time_scale=time_scale,
+            channels=_Channels(self),
+            _channel_names=[name.strip() for name in str(channels or "").split(",") if name.strip()],
+            _rng=np.random.default_rng(sum(resource_name.encode())),
+            _advanced_sequences={},
+        )
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self.__dict__.update(
+            output_function=None,
+            source_mode=None,
+            measure_when=None,
+            voltage_level=0.0,
+            current_level=0.0,
+            current_limit=0.0,
+            source_delay=0.0,
+            aperture_time=0.0,
+            measure_record_length=1,
+            measure_record_length_is_finite=True,
+            active_advanced_sequence="",
+            _sequence=[],
+            _sequence_steps=None,
+            _running=False,
+            _initiated_at=0.0,
+            _records_fetched=0,
+            _channel_fetched={},
+        )
+
+    def _channel_view(self, key: str) -> Any:
+        # single channels of a multi-channel session fetch their records independently
+        if len(self._channel_names) > 1 and str(key).strip() in self._channel_names:
+            return _FakeDCPowerChannel(self, str(key).strip())
+        return self
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        # levels written after create_advanced_sequence_step() belong to that step
+        if (name in ("voltage_level", "current_limit", "current_level") and self.active_advanced_sequence
+                and self._sequence_steps):
+            self._sequence_steps[-1][name] = value
+        self.__dict__[name] = value
+
+    def __enter__(self) -> "FakeDCPowerSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def fetch_backlog(self) -> int:
+        return self._records_available() - self._records_fetched
+
+    def commit(self) -> None:
+        pass
+
+    def initiate(self) -> _Initiated:
+        self.__dict__.update(_running=True, _initiated_at=time.monotonic(), _records_fetched=0, _channel_fetched={})
+        return _Initiated(self)
+
+    def abort(self) -> None:
+        self.__dict__["_running"] = False
+
+    def reset(self) -> None:
+        self._reset_state()
+
+    def close(self) -> None:
+        self.__dict__["_running"] = False
+
+    def configure_aperture_time(self, aperture_time: float, units: Any = None) -> None:
+        self.aperture_time = aperture_time
+
+    def create_advanced_sequence(self, sequence_name: str, property_names: List[str], set_as_active_sequence=True):
+        # like the driver, the advanced sequences stay defined until they are deleted, also across reset()
+        if sequence_name in self._advanced_sequences:
+            raise nidcpower.errors.DriverError(-1074118494, f"The advanced sequence '{sequence_name}' already exists.")
+        self._advanced_sequences[sequence_name] = []
+        self.__dict__.update(_sequence_steps=self._advanced_sequences[sequence_name],
+                             active_advanced_sequence=sequence_name)
+
+    def delete_advanced_sequence(self, sequence_name: str) -> None:
+        if self._advanced_sequences.pop(sequence_name, None) is None:
+            raise nidcpower.errors.DriverError(-1074118493, f"The advanced sequence '{sequence_name}' does not exist.")
+        if self.active_advanced_sequence == sequence_name:
+            self.__dict__.update(_sequence_steps=None, active_advanced_sequence="")
+
+    def create_advanced_sequence_step(self, set_as_active_step=True) -> None:
+        self._sequence_steps.append({})
+
+    def set_sequence(self, values: List[float], source_delays: List[float]) -> None:
+        self.__dict__["_sequence"] = list(values)
+
+    def wait_for_event(self, event_id: Any, timeout: Any = None) -> None:
+        if self.time_scale > 0:
+            time.sleep(self.source_delay * self.time_scale)
+
+    def measure(self, measurement_type: Any) -> float:
+        self._wait_for_on_demand_measurement()
+        measurement = self._make_measurements(1)[0]
+        return measurement.voltage if "VOLTAGE" in str(measurement_type) else measurement.current
+
+    def measure_multiple(self) -> List[Measurement]:
+        self._wait_for_on_demand_measurement()
+        return self._make_measurements(1)
+
+    def _wait_for_on_demand_measurement(self) -> None:
+        if self.time_scale > 0:
+            time.sleep(self.aperture_time * self.time_scale)
+
+    def fetch_multiple(self, count: int, timeout: Any = 1.0) -> List[Measurement]:
+        voltages, currents, in_compliance = self._fetch_multiple(timeout, count)
+        return [Measurement(v, c, i, "0") for v, c, i in zip(voltages, currents, in_compliance)]
+
+    def _fetch_multiple(self, timeout: Any, count: int) -> tuple:
+        # the driver call behind fetch_multiple, it returns the voltages and currents as arrays
+        records = self._fetch(count, timeout, self._records_fetched)
+        self.__dict__["_records_fetched"] += count
+        return records
+
+    def _fetch(self, count: int, timeout: Any, records_fetched: int) -> tuple:
+        if self.time_scale > 0:
+            deadline = time.monotonic() + _seconds(timeout)
+            while self._records_available() - records_fetched < count:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{self.resource_name}: fetch of {count} records timed out.")
+                time.sleep(min(self._record_period(), 0.001))
+        voltages, currents = self._make_records(count, records_fetched)
+        return array.array("d", voltages), array.array("d", currents), [False] * count
+
+    def _record_period(self) -> float:
+        # sequence steps wait for the source delay before every measurement, records do not
+        step_delay = self.source_delay if self._sequence_levels() else 0.0
+        return max(self.aperture_time + step_delay, 1e-6) * self.time_scale
+
+    def _sources_voltage(self) -> bool:
+        return self.output_function is None or "VOLTAGE" in str(self.output_function)
+
+    def _sequence_levels(self) -> List[float]:
+        # an active advanced sequence replaces the simple sequence of set_sequence()
+        if self.active_advanced_sequence:
+            key = "voltage_level" if self._sources_voltage() else "current_level"
+            return [step.get(key, 0.0) for step in self._advanced_sequences[self.active_advanced_sequence]]
+        return self._sequence
+
+    def _records_available(self) -> int:
+        if not self._running:
+            return 0
+        if "ON_MEASURE_TRIGGER" in str(self.measure_when):
+            total = sys.maxsize
+        else:
+            total = len(self._sequence_levels()) or self.measure_record_length
+        if self.time_scale <= 0:
+            return total
+        elapsed = time.monotonic() - self._initiated_at
+        return min(total, int(elapsed / self._record_period()))
+
+    def _make_measurements(self, count: int, first_record: int = 0) -> List[Measurement]:
+        voltages, currents = self._make_records(count, first_record)
+        return [Measurement(float(v), float(c), False, "0") for v, c in zip(voltages, currents)]
+
+    def _make_records(self, count: int, first_record: int = 0) -> tuple:
+        levels = self._sequence_levels()
+        indices = np.arange(first_record, first_record + count)
+        noise = self._rng.normal(0.0, 1e-4, count)
+        if self._sources_voltage():
+            voltages = np.take(levels, indices, mode="wrap") if levels else np.full(count, self.voltage_level)
+            currents = np.full(count, DUT_INPUT_CURRENT) + noise
+            voltages = voltages + noise
+        else:
+            currents = np.take(levels, indices, mode="wrap") if levels else np.full(count, self.current_level)
+            voltages = DUT_OUTPUT_VOLTAGE - 0.01 * currents + noise
+        return voltages, currents
+
+
+class _FakeDCPowerChannel(object):
+    """One channel of a multi-channel FakeDCPowerSession with its own fetch position."""
+
+    def __init__(self, session: FakeDCPowerSession, channel_name: str) -> None:
+        object.__setattr__(self, "_session", session)
+        object.__setattr__(self, "_channel_name", channel_name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._session, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._session, name, value)
+
+    @property
+    def fetch_backlog(self) -> int:
+        return self._session._records_available() - self._records_fetched()
+
+    def fetch_multiple(self, count: int, timeout: Any = 1.0) -> List[Measurement]:
+        voltages, currents, in_compliance = self._fetch_multiple(timeout, count)
+        return [Measurement(v, c, i, self._channel_name) for v, c, i in zip(voltages, currents, in_compliance)]
+
+    def _fetch_multiple(self, timeout: Any, count: int) -> tuple:
+        records = self._session._fetch(count, timeout, self._records_fetched())
+        self._session._channel_fetched[self._channel_name] = self._records_fetched() + count
+        return records
+
+    def _records_fetched(self) -> int:
+        return self._session._channel_fetched.get(self._channel_name, 0)
+
+
+class FakeScopeSession(object):
+    """Stand-in for niscope.Session that digitizes a synthetic PMIC ripple waveform.
+
+    Every channel sees a switching ripple at a twentieth of the sample rate with its second
+    harmonic and some white noise. The phase continues across fetches of a running acquisition.
+    """
+
+    def __init__(self, resource_name: str, *args, time_scale: float = 0.0, **kwargs) -> None:
+        self.resource_name = resource_name
+        self.time_scale = time_scale
+        self.trigger_modifier = None
+        self.horz_sample_rate = 1.0
+        self.horz_min_num_pts = 1
+        self.horz_num_records = 1
+        self.channels = _Channels(self)
+        self._rng = np.random.default_rng(5122)
+        self._read_pointer: Dict[str, int] = {}
+        self._initiated_at = 0.0
+
+    def _channel_view(self, key: str) -> "_FakeScopeChannels":
+        names = [name.strip() for name in str(key).split(",") if name.strip()]
+        return _FakeScopeChannels(self, names)
+
+    def __enter__(self) -> "FakeScopeSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+    def configure_trigger_edge(self, trigger_source: str, level: float, trigger_coupling: Any,
+                               slope: Any = None, holdoff=0.0, delay=0.0) -> None:
+        pass
+
+    def configure_horizontal_timing(self, min_sample_rate: float, min_num_pts: int, ref_position: float,
+                                    num_records: int, enforce_realtime: bool) -> None:
+        self.horz_sample_rate = float(min_sample_rate)
+        self.horz_min_num_pts = int(min_num_pts)
+        self.horz_num_records = int(num_records)
+
+    def initiate(self) -> _Initiated:
+        self._read_pointer = {}
+        self._initiated_at = time.monotonic()
+        return _Initiated(self)
+
+    def _acquire(self, channel_names: List[str], num_samples: int, timeout: Any) -> List[np.ndarray]:
+        start = self._read_pointer.get(channel_names[0], 0)
+        if self.time_scale > 0:
+            ready_at = self._initiated_at + (start + num_samples) / self.horz_sample_rate * self.time_scale
+            wait = ready_at - time.monotonic()
+            if wait > _seconds(timeout):
+                raise TimeoutError(f"{self.resource_name}: fetch of {num_samples} samples timed out.")
+            if wait > 0:
+                time.sleep(wait)
+        n = np.arange(start, start + num_samples)
+        waveforms = []
+        for index, name in enumerate(channel_names):
+            phase = 2 * math.pi * n / 20.0 + index
+            waveforms.append(
+                0.010 * np.sin(phase) + 0.003 * np.sin(2 * phase) + self._rng.normal(0.0, 5e-4, num_samples)
+            )
+            self._read_pointer[name] = start + num_samples
+        return waveforms
+
+    def _waveform_info(self, channel_name: str, samples: Any) -> niscope.WaveformInfo:
+        info = niscope.WaveformInfo(x_increment=1.0 / self.horz_sample_rate)
+        info.relative_initial_x = self._read_pointer[channel_name] / self.horz_sample_rate - len(samples) * info.x_increment
+        info.channel = channel_name
+        info.record = 0
+        info.samples = samples
+        return info
+
+
+class _FakeScopeChannels(object):
+    def __init__(self, session: FakeScopeSession, channel_names: List[str]) -> None:
+        self._session = session
+        self._channel_names = channel_names
+
+    def configure_vertical(self, range: float, coupling: Any, offset=0.0, probe_attenuation=1.0, enabled=True):
+        pass
+
+    def configure_chan_characteristics(self, input_impedance: float, max_input_frequency: float) -> None:
+        pass
+
+    def fetch(self, num_samples: Optional[int] = None, relative_to=None, offset=0, record_number=0,
+              num_records=None, timeout=5.0) -> List[niscope.WaveformInfo]:
+        num_samples = int(num_samples if num_samples is not None else self._session.horz_min_num_pts)
+        waveforms = self._session._acquire(self._channel_names, num_samples, timeout)
+        return [
+            self._session._waveform_info(name, waveform.tolist())
+            for name, waveform in zip(self._channel_names, waveforms)
+        ]
+
+    def fetch_into(self, waveform: np.ndarray, relative_to=None, offset=0, record_number=0, num_records=None,
+                   timeout=5.0) -> List[niscope.WaveformInfo]:
+        num_samples = len(waveform) // len(self._channel_names)
+        waveforms = self._session._acquire(self._channel_names, num_samples, timeout)
+        infos = []
+        for index, (name, data) in enumerate(zip(self._channel_names, waveforms)):
+            view = waveform[index * num_samples:(index + 1) * num_samples]
+            view[:] = data
+            infos.append(self._session._waveform_info(name, view))
+        return infos
+
+
+def _seconds(timeout: Any) -> float:
+    return timeout.total_seconds() if hasattr(timeout, "total_seconds") else float(timeout)
@@ -0,0 +1,354 @@
+"""Benchmark the PMIC measurement services end to end without instruments.
+
+Each measurement service's measure() generator is driven in perform measurement mode against
+in-process fake instruments (default) or NI-DCPower/NI-SCOPE simulated sessions, for a matrix of
+sweep sizes and acquisition lengths. For every case the benchmark reports wall time, per-yield
+latency, bytes serialized to the client, peak Python memory and the number of driver calls.
+"""
+
+import collections
+import functools
+import importlib
+import inspect
+import json
+import pathlib
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+from unittest import mock
+
+import click
+import nidcpower
+import niscope
+from ni_measurementlink_service._internal.parameter import serializer
+
+from fake_instruments import CountingProxy, FakeDCPowerSession, FakeScopeSession
+
+SERVICES_DIRECTORY = pathlib.Path(__file__).resolve().parent.parent / "Measurements - IS Pro Version 24.0"
+
+SERVICE_DIRECTORIES = {
+    "ripple": "ripple",
+    "line_regulation": "line regulation",
+    "efficiency": "efficiency and load regulation",
+    "output_voltage_accuracy": "output voltage accuracy",
+}
+
+SIMULATED_DCPOWER_OPTIONS = {"simulate": True, "driver_setup": {"Model": "4139", "BoardType": "PXIe"}}
+SIMULATED_SCOPE_OPTIONS = {"simulate": True, "driver_setup": {"Model": "5122", "BoardType": "PXI"}}
+
+
+class BenchmarkCase(NamedTuple):
+    """One point of the benchmark matrix."""
+
+    service: str
+    label: str
+    configuration: Dict[str, Any]
+
+
+def build_cases(
+    sweep_sizes: List[int],
+    acquisition_times: List[float],
+    sample_rates: List[float],
+    aperture_time: float,
+) -> List[BenchmarkCase]:
+    """Build the benchmark matrix. Configuration values are keyed by display name."""
+    cases = []
+    for sample_rate in sample_rates:
+        for acquisition_time in acquisition_times:
+            for continuous in (False, True):
+                cases.append(BenchmarkCase(
+                    "ripple",
+                    f"{sample_rate:g} S/s x {acquisition_time:g} s{' cont.' if continuous else ''}",
+                    {
+                        "Sample rate (Hz)": sample_rate,
+                        "Acquisition time (s)": acquisition_time,
+                        "Continuous acquisition": continuous,
+                    },
+                ))
+            cases.append(BenchmarkCase(
+                "ripple",
+                f"{sample_rate:g} S/s x {acquisition_time:g} s 4 rails",
+                {
+                    "Sample rate (Hz)": sample_rate,
+                    "Acquisition time (s)": acquisition_time,
+                    "Continuous acquisition": True,
+                    "Scope channel name": "0,1,2,3",
+                },
+            ))
+    for sweep_size in sweep_sizes:
+        cases.append(BenchmarkCase(
+            "line_regulation", f"{sweep_size} pts", {"Pts/Pts per decade": sweep_size}
+        ))
+        # a power limit of at least stop voltage x current limit keeps the current limit constant over the sweep,
+        # so the source sweep is loaded with set_sequence instead of advanced sequence steps
+        cases.append(BenchmarkCase(
+            "line_regulation",
+            f"{sweep_size} pts const. limit",
+            {"Pts/Pts per decade": sweep_size, "Source maximum power (W)": 500.0},
+        ))
+    for sweep_size in sweep_sizes:
+        cases.append(BenchmarkCase(
+            "efficiency",
+            f"4 x {sweep_size} pts",
+            {"Source voltage sweep points": 4, "Load current sweep points/points per decade": sweep_size},
+        ))
+    for acquisition_time in acquisition_times:
+        cases.append(BenchmarkCase(
+            "output_voltage_accuracy",
+            f"{acquisition_time:g} s / {aperture_time:g} s",
+            {"Measurement duration (s)": acquisition_time, "Aperture time (s)": aperture_time},
+        ))
+        cases.append(BenchmarkCase(
+            "output_voltage_accuracy",
+            f"{acquisition_time:g} s / {aperture_time:g} s 8 rails",
+            {
+                "Measurement duration (s)": acquisition_time,
+                "Aperture time (s)": aperture_time,
+                "Load channel names": "0,1,2,3,4,5,6,7",
+            },
+        ))
+    return cases
+
+
+def load_service(service: str) -> Any:
+    """Import the measurement module of a service in isolation from the other services.
+
+    All services use the same module names (measurement, _helpers, ...), so the modules of the
+    previously loaded service are dropped from sys.modules first.
+    """
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and SERVICES_DIRECTORY in pathlib.Path(module_file).resolve().parents:
+            del sys.modules[name]
+    service_directory = str(SERVICES_DIRECTORY / SERVICE_DIRECTORIES[service])
+    sys.path.insert(0, service_directory)
+    try:
+        return importlib.import_module("measurement")
+    finally:
+        sys.path.remove(service_directory)
+
+
+def make_session_factories(
+    backend: str, time_scale: float, counts: collections.Counter
+) -> Tuple[Callable[..., Any], Callable[..., Any]]:
+    """Return the nidcpower.Session and niscope.Session replacements for a backend."""
+    if backend == "fake":
+        def dcpower_session(resource_name, channels=None, **kwargs):
+            return CountingProxy(FakeDCPowerSession(resource_name, channels, time_scale=time_scale), counts)
+
+        def scope_session(resource_name, *args, **kwargs):
+            return CountingProxy(FakeScopeSession(resource_name, time_scale=time_scale), counts)
+    else:
+        dcpower_class = nidcpower.Session
+        scope_class = niscope.Session
+
+        def dcpower_session(resource_name, channels=None, **kwargs):
+            session = dcpower_class(resource_name=resource_name, channels=channels, options=SIMULATED_DCPOWER_OPTIONS)
+            return CountingProxy(session, counts)
+
+        def scope_session(resource_name, *args, **kwargs):
+            return CountingProxy(scope_class(resource_name, options=SIMULATED_SCOPE_OPTIONS), counts)
+    return dcpower_session, scope_session
+
+
+def run_measurement(service: Any, configuration: Dict[str, Any]) -> Dict[str, Any]:
+    """Drive measure() to completion once and time every step."""
+    arguments = {
+        parameter.display_name: parameter.default_value
+        for parameter in service.measurement_service._configuration_parameter_list
+    }
+    unknown = set(configuration) - set(arguments)
+    if unknown:
+        raise click.ClickException(f"Unknown configuration for {service.__file__}: {sorted(unknown)}")
+    arguments.update(configuration)
+    output_metadata = dict(enumerate(service.measurement_service._output_parameter_list, start=1))
+
+    yield_latencies = []
+    bytes_serialized = 0
+    start = time.perf_counter()
+    generator = service.measure(*arguments.values())
+    if not inspect.isgenerator(generator):
+        generator = _without_updates(generator)
+    while True:
+        step_start = time.perf_counter()
+        try:
+            outputs = next(generator)
+        except StopIteration as stop:
+            outputs = stop.value
+            finished = True
+        else:
+            finished = False
+            yield_latencies.append(time.perf_counter() - step_start)
+        bytes_serialized += len(serializer.serialize_parameters(output_metadata, outputs))
+        if finished:
+            break
+    return {
+        "wall_time": time.perf_counter() - start,
+        "yields": len(yield_latencies),
+        "yield_latencies": yield_latencies,
+        "bytes_serialized": bytes_serialized,
+    }
+
+
+def _without_updates(outputs: Any) -> Any:
+    # measure() functions without intermediate results return their outputs directly
+    return outputs
+    yield
+
+
+def run_case(service: Any, case: BenchmarkCase, repeat: int, counts: collections.Counter) -> Dict[str, Any]:
+    """Benchmark one case: a warm-up run, timed runs and a memory-traced run."""
+    counts.clear()
+    first_run = run_measurement(service, case.configuration)
+
+    timed_runs = []
+    for _ in range(repeat):
+        counts.clear()
+        timed_runs.append(run_measurement(service, case.configuration))
+    driver_calls = dict(counts)
+
+    tracemalloc.start()
+    try:
+        run_measurement(service, case.configuration)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median_run = sorted(timed_runs, key=lambda run: run["wall_time"])[len(timed_runs) // 2]
+    latencies = median_run["yield_latencies"] or [0.0]
+    return {
+        "service": case.service,
+        "case": case.label,
+        "first_run_s": first_run["wall_time"],
+        "wall_time_s": median_run["wall_time"],
+        "yields": median_run["yields"],
+        "yield_latency_mean_ms": statistics.fmean(latencies) * 1e3,
+        "yield_latency_max_ms": max(latencies) * 1e3,
+        "bytes_serialized": median_run["bytes_serialized"],
+        "peak_memory_mb": peak_memory / 2 ** 20,
+        "driver_calls": sum(driver_calls.values()),
+        "driver_calls_by_name": driver_calls,
+    }
+
+
+def compare_to_baseline(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Return a message for every case that is slower or makes more driver calls than the baseline."""
+    baseline_by_case = {(result["service"], result["case"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline_by_case.get((result["service"], result["case"]))
+        if reference is None:
+            continue
+        for metric in ("wall_time_s", "peak_memory_mb", "driver_calls", "bytes_serialized"):
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['service']} [{result['case']}] {metric}: {reference[metric]:.6g} -> {result[metric]:.6g}"
+                )
+    return regressions
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    """Print the results as a table."""
+    header = (
+        f"{'service':<24} {'case':<22} {'first (s)':>10} {'wall (s)':>10} {'yields':>7} "
+        f"{'mean/yield (ms)':>16} {'max/yield (ms)':>15} {'bytes out':>12} {'peak (MB)':>10} {'driver calls':>13}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['service']:<24} {result['case']:<22} {result['first_run_s']:>10.4f} "
+            f"{result['wall_time_s']:>10.4f} {result['yields']:>7} {result['yield_latency_mean_ms']:>16.3f} "
+            f"{result['yield_latency_max_ms']:>15.3f} {result['bytes_serialized']:>12} "
+            f"{result['peak_memory_mb']:>10.2f} {result['driver_calls']:>13}"
+        )
+
+
+def _parse_list(value_type: Callable[[str], Any], ctx: Any, param: Any, value: str) -> List[Any]:
+    try:
+        return [value_type(item) for item in value.split(",") if item.strip()]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@click.command
+@click.option("--backend", type=click.Choice(["fake", "simulated"]), default="fake", show_default=True,
+              help="In-process fake instruments or NI-DCPower/NI-SCOPE simulated sessions.")
+@click.option("--service", "services", type=click.Choice(list(SERVICE_DIRECTORIES)), multiple=True,
+              help="Service to benchmark. Repeat to select several. Defaults to all services.")
+@click.option("--sweep-sizes", default="10,100,1000", show_default=True,
+              callback=functools.partial(_parse_list, int), help="Sweep points for line and efficiency sweeps.")
+@click.option("--acquisition-times", default="1,3", show_default=True,
+              callback=functools.partial(_parse_list, float),
+              help="Ripple acquisition times and output voltage accuracy durations in seconds.")
+@click.option("--sample-rates", default="10000,1000000", show_default=True,
+              callback=functools.partial(_parse_list, float), help="Ripple scope sample rates in S/s.")
+@click.option("--aperture-time", default=0.001, show_default=True,
+              help="Aperture time in seconds for the output voltage accuracy records.")
+@click.option("--repeat", default=3, show_default=True, help="Timed runs per case; the median is reported.")
+@click.option("--time-scale", default=0.0, show_default=True,
+              help="Fake backend only: fraction of real instrument timing to emulate, 0 returns data instantly.")
+@click.option("--incremental", is_flag=True,
+              help="Enable incremental updates, which send only the points added since the previous update.")
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results to this JSON file.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False),
+              help="JSON results of a previous run to check for regressions.")
+@click.option("--tolerance", default=0.25, show_default=True,
+              help="Allowed relative increase over the baseline before a case counts as a regression.")
+def main(
+    backend: str,
+    services: Tuple[str, ...],
+    sweep_sizes: List[int],
+    acquisition_times: List[float],
+    sample_rates: List[float],
+    aperture_time: float,
+    repeat: int,
+    time_scale: float,
+    incremental: bool,
+    output: str,
+    baseline: str,
+    tolerance: float,
+) -> None:
+    """Benchmark the PMIC measurement services."""
+    counts: collections.Counter = collections.Counter()
+    dcpower_session, scope_session = make_session_factories(backend, time_scale, counts)
+    cases = [
+        case for case in build_cases(sweep_sizes, acquisition_times, sample_rates, aperture_time)
+        if not services or case.service in services
+    ]
+    if incremental:
+        # output voltage accuracy returns its results once and has no intermediate updates
+        cases = [
+            case._replace(label=f"{case.label} incr.", configuration={**case.configuration, "Incremental updates": True})
+            if case.service != "output_voltage_accuracy" else case
+            for case in cases
+        ]
+
+    results = []
+    with mock.patch.object(nidcpower, "Session", dcpower_session), mock.patch.object(niscope, "Session", scope_session):
+        for service_name in SERVICE_DIRECTORIES:
+            service_cases = [case for case in cases if case.service == service_name]
+            if not service_cases:
+                continue
+            service = load_service(service_name)
+            try:
+                for case in service_cases:
+                    results.append(run_case(service, case, max(repeat, 1), counts))
+            finally:
+                service.session_pool.close_all()
+
+    print_results(results)
+    if output:
+        pathlib.Path(output).write_text(json.dumps(results, indent=2))
+    if baseline:
+        regressions = compare_to_baseline(results, json.loads(pathlib.Path(baseline).read_text()), tolerance)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}", err=True)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
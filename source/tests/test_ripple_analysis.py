@@ -0,0 +1,45 @@
+"""Tests of the decimated ripple graph of the ripple service."""
+
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "Measurements - IS Pro Version 24.0" / "ripple"))
+
+from ripple_analysis import DecimatedGraph, DoubleXYData  # noqa: E402
+
+DT = 1e-4
+MAX_POINTS = 10000
+CHUNK_SIZE = 3000
+
+
+def _decimated_graph(window_samples: int, total_samples: int) -> DecimatedGraph:
+    graph = DecimatedGraph(DoubleXYData(), MAX_POINTS, window_samples)
+    for start in range(0, total_samples, CHUNK_SIZE):
+        graph.append(np.sin(np.arange(start, min(start + CHUNK_SIZE, total_samples))), DT)
+    graph.flush()
+    return graph
+
+
+@pytest.mark.parametrize("window_samples, bucket_size", [(5000, 1), (10000, 2), (100000, 20)])
+def test_decimated_graph_covers_the_whole_window(window_samples: int, bucket_size: int) -> None:
+    total_samples = int(window_samples * 2.5)
+
+    graph = _decimated_graph(window_samples, total_samples)
+
+    x_data = np.asarray(graph.xy_data.x_data)
+    assert graph.bucket_size == bucket_size
+    assert 0 < x_data.size <= MAX_POINTS
+    # the envelope points are the minimum and maximum of a bucket, so the ends may be off by a bucket
+    tolerance = (bucket_size + 0.5) * DT
+    assert x_data[0] <= (total_samples - window_samples) * DT + tolerance
+    assert x_data[-1] >= (total_samples - 1) * DT - tolerance
+
+
+def test_decimated_graph_of_an_empty_window_is_empty() -> None:
+    graph = _decimated_graph(0, 2 * CHUNK_SIZE)
+
+    assert graph.bucket_size == 1
+    assert len(graph.xy_data.x_data) == 0